@@ -0,0 +1,247 @@
+"""
+Benchmark the framing and decoding functions against a synthetic log, so that changes
+can be compared across versions. The log is made from a seeded random number generator,
+so the same arguments always give the same bytes. Results are written as JSON.
+
+Usage: python bench_ublox.py [--epochs N] [--seed N] [--repeat N] [--output FILE] [--only NAME ...]
+"""
+import argparse
+import io
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from parse_ublox import PacketType, GNSS, ANTSTAT, ANTPWR, encode_ublox, rtcm_frame, nmea_frame, \
+    frame_buffer, next_packet, parse_ublox, parse_gps_sfrbx, parse_gps_sfrbx_batch, np
+from ephemeris_ublox import EphemerisStore
+from parse_rtcm import GLOdow, df_table, rtcm_table, MSM7_ids, MSM7_sat_record, MSM7_sig_record, scale_value, \
+    encode_rtcm, parse_rtcm, parse_msm7
+
+
+def nav_pvt(rng,tow):
+    return encode_ublox("UBX-NAV-PVT",{"iTOW":tow/1000,"year":2022,"month":4,"day":4,"hour":18,"min":19,"sec":11,
+                                       "valid":7,"tAcc":20e-9,"nano":rng.randint(-500,500)*1e-9,"fixType":3,
+                                       "flags":1,"numSV":rng.randint(4,30),"lon":rng.uniform(-180,180),
+                                       "lat":rng.uniform(-90,90),"height":rng.uniform(0,2000),
+                                       "hMSL":rng.uniform(0,2000),"hAcc":rng.uniform(0,5),"vAcc":rng.uniform(0,5),
+                                       "velN":rng.uniform(-0.1,0.1),"velE":rng.uniform(-0.1,0.1),
+                                       "velD":rng.uniform(-0.1,0.1),"pDOP":rng.uniform(0.5,5)})
+
+
+def rxm_rawx(rng,tow,n_meas):
+    values={"rcvTow":tow/1000,"week":2204,"leapS":18,"numMeas":n_meas,"recStat":1,"version":1}
+    rows=[{"prMes":rng.uniform(2e7,2.6e7),"cpMes":rng.uniform(1e8,1.4e8),"doMes":rng.uniform(-5000,5000),
+           "gnssId":rng.choice((GNSS.GPS,GNSS.GAL,GNSS.GLO)),"svId":rng.randint(1,32),
+           "locktime":rng.uniform(0,65),"cno":rng.randint(20,50),"prStdev":0.01*2**rng.randint(0,15),
+           "cpStdev":0.004*rng.randint(0,15),"doStdev":0.002*2**rng.randint(0,15),"trkStat":7}
+          for i in range(n_meas)]
+    for name in rows[0]:
+        values[name]=[row[name] for row in rows]
+    return encode_ublox("UBX-RXM-RAWX",values)
+
+
+def mon_rf(rng):
+    return encode_ublox("UBX-MON-RF",{"nBlocks":2,"blockId":[0,1],"antStatus":[ANTSTAT.OK]*2,
+                                      "antPower":[ANTPWR.ON]*2,
+                                      "noisePerMS":[rng.randint(50,150) for i in range(2)],
+                                      "agcCnt":[rng.random() for i in range(2)],
+                                      "jamInd":[rng.random() for i in range(2)],
+                                      "ofsI":[rng.uniform(-1,0.99) for i in range(2)],
+                                      "magI":[rng.random() for i in range(2)],
+                                      "ofsQ":[rng.uniform(-1,0.99) for i in range(2)],
+                                      "magQ":[rng.random() for i in range(2)]})
+
+
+def rxm_sfrbx(rng,tow,svId,subframe):
+    """
+    GPS LNAV subframe with a valid TLM and HOW and random data. Parity bits are left zero.
+    """
+    words=[(0x8b<<22),((tow//6000) & 0x1ffff)<<13 | subframe<<8]
+    words+=[rng.getrandbits(24)<<6 for i in range(8)]
+    return encode_ublox("UBX-RXM-SFRBX",{"gnssId":GNSS.GPS,"svId":svId,"numWords":10,"version":2,"dwrd":words})
+
+
+def random_df(rng,df):
+    """
+    :return: random scaled value of an RTCM data field, covering the whole range of the field
+    """
+    name,bits,signed,scale,unit,fmt=df_table[df]
+    raw=rng.randint(-(1<<(bits-1)),(1<<(bits-1))-1) if signed else rng.getrandbits(bits)
+    return scale_value(raw,scale)
+
+
+def rtcm_1005(rng):
+    values={df_table[df].name:random_df(rng,df) for df in rtcm_table[1005][3] if df>=0}
+    values.update({"ITRFyear":0,"GPSind":True,"GLOind":True,"GALind":False,"refind":False,"SROscInd":False,"qcind":0})
+    return rtcm_frame(encode_rtcm(1005,values))
+
+
+def rtcm_msm7(rng,msgNum,tow):
+    """
+    MSM7 message with random satellites, signals, and cells
+    """
+    times,satext,sigID=MSM7_ids[msgNum]
+    n_sat=rng.randint(4,12)
+    n_sig=rng.randint(1,min(3,64//n_sat))
+    prns=sorted(rng.sample(range(1,33),n_sat))
+    sigs=sorted(rng.sample(list(sigID),n_sig),key=lambda sig:sig.value)
+    cells=[(prn,sig) for prn in prns for sig in sigs if rng.random()<0.8]
+    values={"staId":rng.randint(0,4095),"mult_msg":False,"iods":0,"cksteerind":0,"extckind":0,
+            "dfsmoothind":False,"gnsssmoothind":0,"sigmask":sum([1<<(32-sig.value) for sig in sigs])}
+    if msgNum==1087:
+        values["glodow"]=GLOdow(tow//86400000)
+        values["glotk"]=tow % 86400000
+    else:
+        values[df_table[times[0]].name]=tow
+    for df in MSM7_sat_record[0]+list(satext)+MSM7_sat_record[1]:
+        if df>=0:
+            values[df_table[df].name]={prn:random_df(rng,df) for prn in prns}
+    for df in MSM7_sig_record:
+        values[df_table[df].name]={cell:random_df(rng,df) for cell in cells}
+    return rtcm_frame(encode_rtcm(msgNum,values))
+
+
+def make_corpus(n_epochs=1000,seed=0):
+    """
+    Make a synthetic log, with one second of receiver output per epoch:
+    NMEA GGA and RMC, NAV-PVT, RXM-RAWX, MON-RF, a few RXM-SFRBX, and RTCM 1005, 1077, 1087, and 1097.
+
+    :param n_epochs: number of epochs
+    :param seed: seed for the random number generator
+    :return: bytes of log
+    """
+    rng=random.Random(seed)
+    parts=[]
+    for i_epoch in range(n_epochs):
+        tow=(345600+i_epoch)*1000
+        hms=f"{18+i_epoch//3600 % 6:02d}{i_epoch//60 % 60:02d}{i_epoch % 60:02d}.00"
+        parts.append(nmea_frame(f"GNGGA,{hms},4000.{rng.randint(0,99999):05d},N,10500.{rng.randint(0,99999):05d},W,1,12,0.5,1600.0,M,-20.0,M,,"))
+        parts.append(nmea_frame(f"GNRMC,{hms},A,4000.{rng.randint(0,99999):05d},N,10500.{rng.randint(0,99999):05d},W,0.01,,040422,,,A"))
+        parts.append(nav_pvt(rng,tow))
+        parts.append(rxm_rawx(rng,tow,rng.randint(8,40)))
+        if i_epoch % 10==0:
+            parts.append(mon_rf(rng))
+        if i_epoch % 6==0:
+            for svId in rng.sample(range(1,33),4):
+                parts.append(rxm_sfrbx(rng,tow,svId,(i_epoch//6) % 5+1))
+        parts.append(rtcm_1005(rng))
+        for msgNum in MSM7_ids:
+            parts.append(rtcm_msm7(rng,msgNum,tow))
+    return b''.join(parts)
+
+
+def bench_next_packet(buf):
+    inf=io.BytesIO(buf)
+    n=0
+    while inf.tell()<len(buf):
+        packet_type,packet=next_packet(inf)
+        if packet_type is not None:
+            n+=1
+    return n
+
+
+def bench_frame_buffer(buf):
+    n=0
+    for frame in frame_buffer(buf):
+        n+=1
+    return n
+
+
+def bench_ephemeris_store(records):
+    store=EphemerisStore()
+    for record in records:
+        store.add(record)
+    return len(records)
+
+
+def workloads(buf):
+    """
+    Prepare the input of each benchmark, so that only the function of interest is timed
+
+    :param buf: log from make_corpus()
+    :return: dict keyed on benchmark name of tuples:
+      * function to time, taking the prepared input and returning number of messages handled
+      * prepared input
+      * number of bytes handled
+    """
+    frames=[(packet_type,bytes(packet)) for packet_type,ofs,packet in frame_buffer(buf)]
+    ubx=[packet for packet_type,packet in frames if packet_type==PacketType.UBLOX]
+    rtcm=[packet for packet_type,packet in frames if packet_type==PacketType.RTCM]
+    msm=[(packet[3:-3],(packet[3]<<4) | (packet[4]>>4)) for packet in rtcm]
+    msm=[(payload,msgNum) for payload,msgNum in msm if msgNum in MSM7_ids]
+    sfrbx=[parse_ublox(packet) for packet in ubx if packet[2]==0x02 and packet[3]==0x13]
+    result={
+        "next_packet":(bench_next_packet,buf,len(buf)),
+        "frame_buffer":(bench_frame_buffer,buf,len(buf)),
+        "parse_ublox":(lambda packets:len([parse_ublox(packet) for packet in packets]),ubx,
+                       sum([len(packet) for packet in ubx])),
+        "parse_rtcm":(lambda packets:len([parse_rtcm(packet) for packet in packets]),rtcm,
+                      sum([len(packet) for packet in rtcm])),
+        "parse_msm7":(lambda payloads:len([parse_msm7(payload,msgNum) for payload,msgNum in payloads]),msm,
+                      sum([len(payload) for payload,msgNum in msm])),
+        "parse_gps_sfrbx":(lambda packets:len([parse_gps_sfrbx(packet) for packet in packets]),sfrbx,
+                           sum([len(packet.payload) for packet in sfrbx])),
+        # Each subframe ten times in a row, like a satellite repeating an unchanged ephemeris
+        "ephemeris_store":(bench_ephemeris_store,[packet for packet in sfrbx for i in range(10)],
+                           10*sum([len(packet.payload) for packet in sfrbx])),
+    }
+    if np is not None:
+        result["parse_gps_sfrbx_batch"]=(
+            lambda dwrds:sum([len(record.index) for record in parse_gps_sfrbx_batch(dwrds).values()]),
+            np.array([packet.dwrd for packet in sfrbx],dtype=np.uint32),sum([len(packet.payload) for packet in sfrbx]))
+    return result
+
+
+def run_benchmark(func,data,n_bytes,repeat=5):
+    """
+    Time one benchmark, then run it once more under tracemalloc to find its peak memory use
+
+    :return: dict of results. The time is the best of the repeats.
+    """
+    best=float('inf')
+    for i in range(repeat):
+        t0=time.perf_counter()
+        n_msgs=func(data)
+        best=min(best,time.perf_counter()-t0)
+    tracemalloc.start()
+    func(data)
+    current,peak=tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds":best,
+            "bytes":n_bytes,
+            "messages":n_msgs,
+            "MB_per_s":n_bytes/best/1e6,
+            "msgs_per_s":n_msgs/best,
+            "peak_bytes":peak}
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Benchmark parse_ublox against a synthetic log")
+    parser.add_argument("--epochs",type=int,default=1000,help="number of one-second epochs in the log")
+    parser.add_argument("--seed",type=int,default=0,help="seed for making the log")
+    parser.add_argument("--repeat",type=int,default=5,help="number of timed runs of each benchmark")
+    parser.add_argument("--output",help="file to write JSON results to, default standard output")
+    parser.add_argument("--only",nargs="+",help="names of benchmarks to run, default all")
+    args=parser.parse_args(argv)
+    buf=make_corpus(args.epochs,args.seed)
+    results={}
+    for name,(func,data,n_bytes) in workloads(buf).items():
+        if args.only is None or name in args.only:
+            results[name]=run_benchmark(func,data,n_bytes,args.repeat)
+    report={"python":platform.python_version(),
+            "platform":platform.platform(),
+            "corpus":{"epochs":args.epochs,"seed":args.seed,"bytes":len(buf)},
+            "results":results}
+    if args.output is None:
+        json.dump(report,sys.stdout,indent=2)
+        print()
+    else:
+        with open(args.output,"w") as ouf:
+            json.dump(report,ouf,indent=2)
+
+
+if __name__=="__main__":
+    main()
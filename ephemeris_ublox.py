@@ -0,0 +1,245 @@
+"""
+Collect the GPS ephemerides broadcast in UBX-RXM-SFRBX, keeping the current ephemeris of
+each satellite.
+
+Each satellite sends the same subframes 1-3 every 30 s until its ephemeris is updated (every
+couple of hours), so the store remembers the data words of the last copy of each subframe it
+decoded, and only decodes a subframe again when they change. An ephemeris is put together
+once subframe 1, 2, and 3 with matching issue of data (IODC and IODE) have all been seen.
+
+sat_states() evaluates satellite positions, velocities, and clocks from the ephemerides in a
+store, for whole arrays of times and satellites at once, following IS-GPS-200 20.3.3.4.3.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+from parse_ublox import PacketType, GNSS, np, map_file, frame_buffer, parse_ublox_lazy, parse_gps_sfrbx, Subscription, \
+    ublox_cls_id, subframe_123, tlm_struct, how_struct
+
+sfrbx_cls_id=ublox_cls_id("UBX-RXM-SFRBX")
+
+# Fields of an ephemeris: the satellite, then the fields of subframes 1, 2, and 3, leaving out
+# the TLM and HOW and the second copy of IODE
+ephemeris_fields=["gnssId","svId"]+list(dict.fromkeys([name for subframe in (1,2,3) for name in subframe_123[subframe]
+                                                       if name not in tlm_struct and name not in how_struct]))
+ephemeris=namedtuple("ephemeris"," ".join(ephemeris_fields))
+
+
+class EphemerisStore:
+    """
+    Current ephemeris of each satellite, built up from SFRBX packets as they are added
+    """
+    def __init__(self):
+        # Current ephemeris, keyed on gnssId and svId
+        self.current={}
+        # Every ephemeris seen, keyed on gnssId, svId, and IODE. An ephemeris replaces an older
+        # one with the same IODE, so there are at most 256 per satellite.
+        self.versions={}
+        # Data words (3-10) of the last decoded copy of each subframe, keyed on gnssId, svId,
+        # and subframe number
+        self.words={}
+        # Last decoded copy of each subframe, keyed the same way
+        self.subframes={}
+        self.n_decoded=0
+        self.n_skipped=0
+
+    def add(self,sfrbx):
+        """
+        Add one subframe
+
+        :param sfrbx: record of UBX-RXM-SFRBX from parse_ublox() or parse_ublox_lazy()
+        :return: new ephemeris, if this subframe completed one which is different from the
+                 current ephemeris of the satellite, otherwise None. Records of other packet
+                 types are ignored.
+        """
+        if (sfrbx.cls,sfrbx.id)!=sfrbx_cls_id:
+            return None
+        # L1C/A only, since the other GPS signals carry other navigation messages
+        if sfrbx.gnssId!=GNSS.GPS or sfrbx.sigId!=0 or sfrbx.numWords!=10:
+            return None
+        payload=sfrbx.payload
+        subframe=(int.from_bytes(payload[12:16],"little")>>8) & 0x07
+        if subframe not in subframe_123:
+            return None
+        key=(sfrbx.gnssId,sfrbx.svId,subframe)
+        # The words after the HOW of a subframe are the same in every copy of it until the
+        # ephemeris changes, so an unchanged copy has nothing new to decode
+        words=bytes(payload[16:48])
+        if self.words.get(key)==words:
+            self.n_skipped+=1
+            return None
+        self.words[key]=words
+        self.subframes[key]=parse_gps_sfrbx(sfrbx)
+        self.n_decoded+=1
+        return self.assemble(sfrbx.gnssId,sfrbx.svId)
+
+    def assemble(self,gnssId,svId):
+        """
+        Put together an ephemeris from the last copy of each subframe of a satellite
+
+        :return: new ephemeris if the subframes all have the same issue of data and make an
+                 ephemeris different from the current one, otherwise None
+        """
+        sf1=self.subframes.get((gnssId,svId,1))
+        sf2=self.subframes.get((gnssId,svId,2))
+        sf3=self.subframes.get((gnssId,svId,3))
+        if sf1 is None or sf2 is None or sf3 is None:
+            return None
+        # During an upload the subframes change one at a time, so wait until they agree
+        if (sf1.iodc & 0xff)!=sf2.iode or sf3.iode!=sf2.iode:
+            return None
+        values={"gnssId":gnssId,"svId":svId,**sf3._asdict(),**sf2._asdict(),**sf1._asdict()}
+        eph=ephemeris._make([values[name] for name in ephemeris_fields])
+        if self.current.get((gnssId,svId))==eph:
+            return None
+        self.current[(gnssId,svId)]=eph
+        self.versions[(gnssId,svId,eph.iode)]=eph
+        return eph
+
+    def get(self,gnssId,svId,iode=None):
+        """
+        :param gnssId: GNSS of satellite
+        :param svId: number of satellite
+        :param iode: issue of data of the ephemeris wanted, or None for the current one
+        :return: ephemeris, or None if there isn't one
+        """
+        if iode is None:
+            return self.current.get((gnssId,svId))
+        return self.versions.get((gnssId,svId,iode))
+
+
+def load_ephemerides(source,store=None):
+    """
+    Add all the GPS subframes in a log to an ephemeris store. Only the SFRBX packets are decoded.
+
+    :param source: name of log file, or buffer holding log as for frame_buffer()
+    :param store: EphemerisStore to add to, or None for a new one
+    :return: the store
+    """
+    if store is None:
+        store=EphemerisStore()
+    buf=map_file(source) if isinstance(source,str) else source
+    for packet_type,ofs,packet in frame_buffer(buf,subscribe=Subscription(["UBX-RXM-SFRBX"])):
+        if packet_type==PacketType.UBLOX and (packet[2],packet[3])==sfrbx_cls_id:
+            store.add(parse_ublox_lazy(packet))
+    return store
+
+
+# Constants from IS-GPS-200, which have to be these exact values to match the ephemerides
+gps_mu=3.986005e14            # m**3/s**2, gravitational parameter of Earth
+gps_omega_e=7.2921151467e-5   # rad/s, rotation rate of Earth
+gps_F=-4.442807633e-10        # s/m**0.5, relativistic clock correction constant
+gps_pi=3.1415926535898        # value of pi used to convert semicircles to radians
+half_week=302400
+
+# Things about an ephemeris which don't depend on time, all in radians and seconds
+ephemeris_params=namedtuple("ephemeris_params","A n e sqrt_1_e2 M_0 omega c_uc c_us c_rc c_rs c_ic c_is "
+                                               "i_0 i_dot Omega_0 Omega_dot t_oe t_oc a_f0 a_f1 a_f2 F_e_sqrtA")
+
+# Position and velocity in ECEF (m and m/s, one row of x, y, z per element), and clock bias
+# and drift (s and s/s) of satellites
+sat_state=namedtuple("sat_state","pos vel clock_bias clock_drift")
+
+
+@lru_cache(maxsize=4096)
+def get_ephemeris_params(eph):
+    """
+    :param eph: ephemeris from EphemerisStore
+    :return: ephemeris_params of ephemeris, worked out once and cached
+    """
+    sqrtA=eph.A**0.5
+    return ephemeris_params(A=eph.A,n=(gps_mu/eph.A**3)**0.5+eph.delta_n*gps_pi,e=eph.e,sqrt_1_e2=(1-eph.e**2)**0.5,
+                            M_0=eph.M_0*gps_pi,omega=eph.omega*gps_pi,c_uc=eph.c_uc,c_us=eph.c_us,c_rc=eph.c_rc,
+                            c_rs=eph.c_rs,c_ic=eph.c_ic,c_is=eph.c_is,i_0=eph.i_0*gps_pi,i_dot=eph.i_dot*gps_pi,
+                            # Right ascension at the start of the week, so that only tk is needed later
+                            Omega_0=eph.Omega_0*gps_pi-gps_omega_e*eph.t_oe,
+                            Omega_dot=eph.Omega_dot*gps_pi-gps_omega_e,
+                            t_oe=eph.t_oe,t_oc=eph.t_oc,a_f0=eph.a_f0,a_f1=eph.a_f1,a_f2=eph.a_f2,
+                            F_e_sqrtA=gps_F*eph.e*sqrtA)
+
+
+def wrap_week(dt):
+    """
+    :return: time differences, corrected for crossing the start or end of a week
+    """
+    return dt-604800*((dt>half_week).astype(np.int64)-(dt<-half_week).astype(np.int64))
+
+
+def sat_states(store,t,svId,iode=None):
+    """
+    Evaluate GPS satellite positions, velocities, and clocks from broadcast ephemerides
+
+    :param store: EphemerisStore to take ephemerides from
+    :param t: GPS time of week in seconds, array-like (or a scalar for all satellites)
+    :param svId: satellite numbers, array-like the same shape as t (or a scalar)
+    :param iode: issue of data of the ephemeris to use for each element, or None to use
+                 the current ephemeris of each satellite
+    :return: sat_state of arrays, one element (or row, for pos and vel) for each element of
+             t and svId. Elements with no ephemeris are NaN. The clock bias includes the
+             relativistic correction but not T_GD, which single-frequency L1 users need to
+             subtract as well.
+    """
+    if np is None:
+        raise ImportError("NumPy is required for sat_states()")
+    t,svId=np.broadcast_arrays(np.asarray(t,dtype=np.float64),np.asarray(svId,dtype=np.int64))
+    t=t.ravel()
+    keys=svId.ravel()*256
+    if iode is not None:
+        keys=keys+np.broadcast_to(np.asarray(iode,dtype=np.int64),svId.shape).ravel()
+    # Look up and precompute each ephemeris once, then spread the parameters out to every element
+    unique,inverse=np.unique(keys,return_inverse=True)
+    table=np.full((len(unique),len(ephemeris_params._fields)),np.nan)
+    for i,key in enumerate(unique.tolist()):
+        eph=store.get(GNSS.GPS,key//256,None if iode is None else key % 256)
+        if eph is not None:
+            table[i]=get_ephemeris_params(eph)
+    p=ephemeris_params._make(table[inverse.ravel()].T)
+    tk=wrap_week(t-p.t_oe)
+    M=p.M_0+p.n*tk
+    # Solve Kepler's equation by Newton's method. GPS orbits are nearly circular, so this
+    # converges to machine precision in a few steps.
+    E=M.copy()
+    for i in range(10):
+        dE=(E-p.e*np.sin(E)-M)/(1-p.e*np.cos(E))
+        E-=dE
+        if not np.nanmax(np.abs(dE),initial=0)>1e-14:
+            break
+    sinE=np.sin(E)
+    cosE=np.cos(E)
+    one_e_cosE=1-p.e*cosE
+    nu=np.arctan2(p.sqrt_1_e2*sinE,cosE-p.e)
+    Phi=nu+p.omega
+    sin2Phi=np.sin(2*Phi)
+    cos2Phi=np.cos(2*Phi)
+    u=Phi+p.c_us*sin2Phi+p.c_uc*cos2Phi
+    r=p.A*one_e_cosE+p.c_rs*sin2Phi+p.c_rc*cos2Phi
+    inc=p.i_0+p.c_is*sin2Phi+p.c_ic*cos2Phi+p.i_dot*tk
+    Omega=p.Omega_0+p.Omega_dot*tk
+    # Rates of the above, for velocity
+    E_dot=p.n/one_e_cosE
+    nu_dot=E_dot*p.sqrt_1_e2/one_e_cosE
+    u_dot=nu_dot*(1+2*(p.c_us*cos2Phi-p.c_uc*sin2Phi))
+    r_dot=p.e*p.A*E_dot*sinE+2*nu_dot*(p.c_rs*cos2Phi-p.c_rc*sin2Phi)
+    inc_dot=p.i_dot+2*nu_dot*(p.c_is*cos2Phi-p.c_ic*sin2Phi)
+    # Position in the orbital plane, then rotated into ECEF
+    cosu=np.cos(u)
+    sinu=np.sin(u)
+    xp=r*cosu
+    yp=r*sinu
+    xp_dot=r_dot*cosu-r*u_dot*sinu
+    yp_dot=r_dot*sinu+r*u_dot*cosu
+    cosO=np.cos(Omega)
+    sinO=np.sin(Omega)
+    cosi=np.cos(inc)
+    sini=np.sin(inc)
+    pos=np.stack([xp*cosO-yp*cosi*sinO,
+                  xp*sinO+yp*cosi*cosO,
+                  yp*sini],axis=-1)
+    vel=np.stack([-pos[:,1]*p.Omega_dot+xp_dot*cosO-yp_dot*cosi*sinO+yp*inc_dot*sini*sinO,
+                  pos[:,0]*p.Omega_dot+xp_dot*sinO+yp_dot*cosi*cosO-yp*inc_dot*sini*cosO,
+                  yp_dot*sini+yp*inc_dot*cosi],axis=-1)
+    dt=wrap_week(t-p.t_oc)
+    clock_bias=p.a_f0+(p.a_f1+p.a_f2*dt)*dt+p.F_e_sqrtA*sinE
+    clock_drift=p.a_f1+2*p.a_f2*dt+p.F_e_sqrtA*cosE*E_dot
+    shape=svId.shape
+    return sat_state(pos.reshape(shape+(3,)),vel.reshape(shape+(3,)),clock_bias.reshape(shape),clock_drift.reshape(shape))
@@ -0,0 +1,331 @@
+"""
+Stream decoded packets into columnar files, one table per message type, written a row group
+at a time so that memory use doesn't grow with the size of the log. Needs pyarrow.
+
+Tables are named like the metrics keys: UBX-xxx-xxx, RTCM-nnnn, and NMEA-xxx. Column types
+come from the packet descriptions (ublox_packets, df_table, and nmea_table), with units kept
+in the field metadata. Every table also has an ofs column with the offset of each packet in the log.
+"""
+import os
+import re
+import struct
+from enum import Enum
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa=None
+
+from parse_ublox import PacketType, get_ublox_desc, map_file, frame_buffer, parse_packet, packet_name
+from parse_rtcm import df_table, get_rtcm_desc, MSM7_ids, MSM7_sat_record, MSM7_sig_record
+from parse_nmea import nmea_str, get_nmea_desc, sentence_id
+
+
+def arrow_field(name,type,unit=None,repeat=False):
+    """
+    :param name: name of column
+    :param type: pyarrow type of each value
+    :param unit: physical units, stored in the field metadata, or None
+    :param repeat: If true, each row holds a list of values
+    :return: pyarrow field
+    """
+    return pa.field(name,pa.list_(type) if repeat else type,metadata=None if unit is None else {"unit":unit})
+
+
+# pyarrow type for each struct code, unscaled
+struct_arrow_types={"B":"uint8","H":"uint16","I":"uint32","b":"int8","h":"int16","i":"int32","f":"float32","d":"float64"}
+
+
+def ublox_type(code,scale,vscale):
+    """
+    :param code: struct code of field
+    :param scale: scale from compile()
+    :param vscale: vector scale from compile()
+    :return: pyarrow type of scaled field
+    """
+    if isinstance(scale,type) and issubclass(scale,Enum):
+        return pa.string()
+    if code[-1]=="s":
+        return pa.binary()
+    if vscale is not None:
+        return pa.float64()
+    return getattr(pa,struct_arrow_types[code])()
+
+
+def ublox_schema(cls,id):
+    """
+    :return: pyarrow schema for a UBlox packet type. Repeating block fields are list columns,
+             and there is an n_rep column if there is a repeating block. None if the packet has
+             no description.
+    """
+    packet_desc=get_ublox_desc(cls,id).packet_desc
+    if packet_desc is None:
+        return None
+    fields=[pa.field("ofs",pa.int64())]
+    parts=((packet_desc.hn,packet_desc.ht,packet_desc.hs,packet_desc.hv,packet_desc.hu,False),
+           (packet_desc.bn,packet_desc.bt,packet_desc.bs,packet_desc.bv,packet_desc.bu,True),
+           (packet_desc.fn,packet_desc.ft,packet_desc.fs,packet_desc.fv,packet_desc.fu,False))
+    for names,types,scales,vscales,units,repeat in parts:
+        for name,code,scale,vscale,unit in zip(names,re.findall(r"\d*[a-zA-Z]",types[1:]),scales,vscales,units):
+            fields.append(arrow_field(name,ublox_type(code,scale,vscale),unit,repeat))
+    if packet_desc.m>0:
+        fields.append(pa.field("n_rep",pa.int32()))
+    return pa.schema(fields)
+
+
+def rtcm_type(df):
+    """
+    :return: pyarrow type of scaled data field
+    """
+    name,bits,signed,scale,unit,fmt=df_table[df]
+    if scale is bool:
+        return pa.bool_()
+    if isinstance(scale,type) and issubclass(scale,Enum):
+        return pa.string()
+    if scale is not None:
+        return pa.float64()
+    if signed:
+        return pa.int64()
+    return pa.uint64() if bits>32 else pa.uint32()
+
+
+def rtcm_schema(msgNum):
+    """
+    :return: pyarrow schema for an RTCM message type, or None if it isn't described. MSM
+             satellite fields are list columns in the order of the prns column, and signal
+             fields are list columns in the order of the cell_prn and cell_sig columns.
+    """
+    desc=get_rtcm_desc(msgNum)
+    if desc is None:
+        return None
+    fields=[pa.field("ofs",pa.int64())]
+    if msgNum in MSM7_ids:
+        times,satext,sigID=MSM7_ids[msgNum]
+        sat_dfs=MSM7_sat_record[0]+list(satext)+MSM7_sat_record[1]
+        for df in desc.dfs:
+            if df>=0:
+                fields.append(arrow_field(df_table[df].name,rtcm_type(df),df_table[df].unit,
+                                          df in sat_dfs or df in MSM7_sig_record))
+        fields+=[pa.field("prns",pa.list_(pa.uint8())),
+                 pa.field("cell_prn",pa.list_(pa.uint8())),
+                 pa.field("cell_sig",pa.list_(pa.string()))]
+    else:
+        for df in desc.dfs:
+            if df>=0:
+                fields.append(arrow_field(df_table[df].name,rtcm_type(df),df_table[df].unit))
+    return pa.schema(fields)
+
+
+def nmea_type(conv):
+    """
+    :return: pyarrow type of a field converted by conv
+    """
+    if conv is int:
+        return pa.int64()
+    if conv is nmea_str:
+        return pa.string()
+    return pa.float64()
+
+
+def nmea_schema(sentence):
+    """
+    :return: pyarrow schema for an NMEA sentence type, or None if it isn't in nmea_table.
+             Repeating fields (like the satellites in GSV) are list columns.
+    """
+    desc=get_nmea_desc(sentence)
+    if desc is None:
+        return None
+    fields=[pa.field("ofs",pa.int64()),pa.field("talker",pa.string())]
+    for name,(i_field,width,conv),unit in zip(desc.names,desc.layout,desc.units):
+        fields.append(arrow_field(name,nmea_type(conv),unit))
+    if desc.repeat is not None:
+        names,i_first,width,conv=desc.repeat
+        for name in names:
+            fields.append(arrow_field(name,nmea_type(conv),None,True))
+    return pa.schema(fields)
+
+
+def arrow_value(value):
+    """
+    Convert a field value to something pyarrow takes: enums to their names, bytes-like objects
+    to bytes, NumPy arrays to lists
+    """
+    if isinstance(value,Enum):
+        return value.name
+    if isinstance(value,memoryview):
+        return bytes(value)
+    if isinstance(value,list):
+        return [arrow_value(x) for x in value]
+    if hasattr(value,"tolist"):
+        return value.tolist()
+    return value
+
+
+def record_row(packet_type,ofs,parsed,schema):
+    """
+    :return: dict of column values for one packet, keyed on column name
+    """
+    values=parsed._asdict()
+    row={"ofs":ofs}
+    if packet_type==PacketType.RTCM and parsed.msgNum in MSM7_ids:
+        sat_keys=None
+        cell_keys=None
+        for field in schema:
+            name=field.name
+            if name not in values:
+                continue
+            value=values[name]
+            if isinstance(value,dict):
+                keys=list(value.keys())
+                if len(keys)>0 and isinstance(keys[0],tuple):
+                    cell_keys=keys
+                else:
+                    sat_keys=keys
+                value=list(value.values())
+            row[name]=arrow_value(value)
+        row["prns"]=sat_keys or []
+        row["cell_prn"]=[prn for prn,sig in cell_keys or []]
+        row["cell_sig"]=[sig.name for prn,sig in cell_keys or []]
+        return row
+    for field in schema:
+        if field.name in values:
+            row[field.name]=arrow_value(values[field.name])
+    return row
+
+
+class TableWriter:
+    """
+    Rows of one table, buffered until there are enough for a row group
+    """
+    def __init__(self,filename,schema,row_group_size,format):
+        self.filename=filename
+        self.schema=schema
+        self.row_group_size=row_group_size
+        self.format=format
+        self.columns={field.name:[] for field in schema}
+        self.n_rows=0
+        self.writer=None
+
+    def add(self,row):
+        for name,column in self.columns.items():
+            column.append(row.get(name))
+        self.n_rows+=1
+        if self.n_rows>=self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered rows as one row group
+        """
+        if self.n_rows==0:
+            return
+        table=pa.Table.from_pydict(self.columns,schema=self.schema)
+        if self.writer is None:
+            if self.format=="parquet":
+                self.writer=pq.ParquetWriter(self.filename,self.schema)
+            else:
+                self.writer=pa.ipc.new_file(self.filename,self.schema)
+        if self.format=="parquet":
+            self.writer.write_table(table,row_group_size=self.row_group_size)
+        else:
+            self.writer.write_table(table,max_chunksize=self.row_group_size)
+        self.columns={field.name:[] for field in self.schema}
+        self.n_rows=0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ArrowExporter:
+    """
+    Write decoded packets to one file per message type. Each table holds at most row_group_size
+    rows in memory before writing them out, so memory use is bounded by the number of message
+    types, not the length of the log.
+    """
+    def __init__(self,directory,row_group_size=65536,format="parquet"):
+        """
+        :param directory: directory to write to, created if needed. Files are named after the
+                          tables, like UBX-NAV-PVT.parquet
+        :param row_group_size: number of rows per row group (Parquet) or record batch (Arrow IPC)
+        :param format: "parquet", or "arrow" for Arrow IPC files
+        """
+        if pa is None:
+            raise ImportError("pyarrow is required for exporting to Parquet or Arrow")
+        if format not in ("parquet","arrow"):
+            raise ValueError(f"Unknown format {format}")
+        os.makedirs(directory,exist_ok=True)
+        self.directory=directory
+        self.row_group_size=row_group_size
+        self.format=format
+        # Table writers keyed on table name. None for message types without a schema.
+        self.tables={}
+
+    def table(self,packet_type,packet):
+        """
+        :return: TableWriter for the message type of a packet, or None if it has no description
+        """
+        name=packet_name(packet_type,packet)
+        if name not in self.tables:
+            if packet_type==PacketType.UBLOX:
+                schema=ublox_schema(packet[2],packet[3])
+            elif packet_type==PacketType.RTCM:
+                schema=rtcm_schema((packet[3]<<4) | (packet[4]>>4))
+            else:
+                schema=nmea_schema(sentence_id(packet))
+            self.tables[name]=None if schema is None else \
+                TableWriter(os.path.join(self.directory,f"{name}.{self.format}"),schema,self.row_group_size,self.format)
+        return self.tables[name]
+
+    def add(self,packet_type,ofs,packet,parsed):
+        """
+        Add one decoded packet
+
+        :param packet_type: PacketType of packet
+        :param ofs: offset of packet in log
+        :param packet: complete packet
+        :param parsed: record from parse_packet()
+        """
+        table=self.table(packet_type,packet)
+        if table is not None and parsed is not None:
+            table.add(record_row(packet_type,ofs,parsed,table.schema))
+
+    def close(self):
+        """
+        Write out the remaining rows and close all the files
+        """
+        for table in self.tables.values():
+            if table is not None:
+                table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+
+def export_log(source,directory,row_group_size=65536,format="parquet",subscribe=None):
+    """
+    Decode a whole log into one file per message type
+
+    :param source: name of log file, or buffer holding log as for frame_buffer()
+    :param directory: directory to write to
+    :param row_group_size: number of rows per row group
+    :param format: "parquet" or "arrow"
+    :param subscribe: Subscription of packets to export, or None for all
+    :return: number of packets which couldn't be decoded, and were left out
+    """
+    buf=map_file(source) if isinstance(source,str) else source
+    n_errors=0
+    with ArrowExporter(directory,row_group_size,format) as exporter:
+        for packet_type,ofs,packet in frame_buffer(buf,subscribe=subscribe):
+            try:
+                parsed=parse_packet(packet_type,packet)
+            except (struct.error,AssertionError,ValueError):
+                n_errors+=1
+                continue
+            exporter.add(packet_type,ofs,packet,parsed)
+    return n_errors
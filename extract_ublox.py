@@ -0,0 +1,102 @@
+"""
+Pull every packet of one type out of a recorded stream as columns, decoding all of
+them in one vectorized pass instead of one parse_ublox() call per packet. Needs NumPy.
+"""
+import numpy as np
+
+from parse_ublox import PacketType, ublox_cls_id, get_ublox_desc, map_file, frame_buffer, scale_column, \
+    Subscription
+
+
+def find_ublox(buf,cls,id,index=None):
+    """
+    Find the payloads of all UBlox packets of one type
+
+    :param buf: buffer holding log, as for frame_buffer()
+    :param cls: class of packet
+    :param id: ID of packet
+    :param index: PacketIndex of the log, or None to frame the log
+    :return: Tuple of NumPy arrays, offset of start of each packet in buf and length of each payload
+    """
+    if index is not None:
+        entries=[entry for entry in index.select([(cls,id)])]
+        offsets=[entry.ofs for entry in entries]
+        lengths=[entry.length-8 for entry in entries]
+    else:
+        offsets=[]
+        lengths=[]
+        for packet_type,ofs,packet in frame_buffer(buf,subscribe=Subscription([(cls,id)])):
+            if packet_type==PacketType.UBLOX and packet[2]==cls and packet[3]==id:
+                offsets.append(ofs)
+                lengths.append(len(packet)-8)
+    return np.array(offsets,dtype=np.int64),np.array(lengths,dtype=np.int64)
+
+
+def gather(data,starts,width,dtype):
+    """
+    Copy equal-sized pieces of a buffer into one contiguous structured array
+
+    :param data: uint8 array of whole log
+    :param starts: array of start positions of pieces
+    :param width: size of each piece in bytes
+    :param dtype: structured dtype of each piece
+    :return: structured array, one element per piece
+    """
+    pieces=data[starts[:,None]+np.arange(width)]
+    return pieces.view(dtype).reshape(len(starts))
+
+
+def extract(source,name,index=None):
+    """
+    Decode every packet of one UBlox type in a log into columns
+
+    :param source: name of log file, or buffer holding log as for frame_buffer()
+    :param name: name of packet in UBX-xxx-xxx form
+    :param index: PacketIndex of the log, or None to frame the log
+    :return: dict of NumPy arrays keyed on field name, with the same scaling as
+             parse_ublox(arrays=True). Header and footer fields have one element per packet.
+             Repeating block fields have one element per row of all packets, concatenated.
+             Also includes:
+      * ofs -- offset of each packet in the log
+      * n_rep -- number of rows in each packet (only if there is a repeating block)
+      * row_offsets -- index of the first row of each packet in the block fields, with one
+        extra element at the end, so the rows of packet i are row_offsets[i]:row_offsets[i+1]
+        (only if there is a repeating block)
+    Packets which are too short for their description, or have a partial row, are skipped.
+    """
+    cls,id=ublox_cls_id(name)
+    packet_desc=get_ublox_desc(cls,id).packet_desc
+    if packet_desc is None:
+        raise ValueError(f"No packet description for {name}")
+    buf=map_file(source) if isinstance(source,str) else source
+    offsets,lengths=find_ublox(buf,cls,id,index)
+    b,m,c=packet_desc.b,packet_desc.m,packet_desc.c
+    if m>0:
+        usable=(lengths>=b+c) & ((lengths-b-c)%m==0)
+    else:
+        usable=lengths>=b
+    offsets=offsets[usable]
+    lengths=lengths[usable]
+    starts=offsets+6
+    data=np.frombuffer(buf,dtype=np.uint8)
+    result={"ofs":offsets}
+    if b>0:
+        header=gather(data,starts,b,packet_desc.hd)
+        for field,vscale in zip(packet_desc.hn,packet_desc.hv):
+            result[field]=scale_column(header[field],vscale)
+    if m>0:
+        n_rep=(lengths-b-c)//m
+        row_offsets=np.zeros(len(n_rep)+1,dtype=np.int64)
+        np.cumsum(n_rep,out=row_offsets[1:])
+        packet_of_row=np.repeat(np.arange(len(n_rep)),n_rep)
+        row_in_packet=np.arange(row_offsets[-1])-row_offsets[packet_of_row]
+        rows=gather(data,starts[packet_of_row]+b+row_in_packet*m,m,packet_desc.bd)
+        for field,vscale in zip(packet_desc.bn,packet_desc.bv):
+            result[field]=scale_column(rows[field],vscale)
+        if c>0:
+            footer=gather(data,starts+b+n_rep*m,c,packet_desc.fd)
+            for field,vscale in zip(packet_desc.fn,packet_desc.fv):
+                result[field]=scale_column(footer[field],vscale)
+        result["n_rep"]=n_rep
+        result["row_offsets"]=row_offsets
+    return result
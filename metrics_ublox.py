@@ -0,0 +1,190 @@
+"""
+Optional counters for the framers and decoders. Nothing is counted unless metrics are
+enabled with enable(), and while they are off the instrumented functions only pay for
+one check of the module-level active value.
+
+Usage:
+    metrics=metrics_ublox.enable()
+    ... frame and decode ...
+    print(metrics.snapshot())
+"""
+import json
+import sys
+import threading
+import time
+from collections import Counter
+
+# Metrics currently being collected, or None if metrics are off
+active=None
+
+# Number of buckets in each decode time histogram. Bucket i counts decodes which took less
+# than 2**i us (and at least half that), and the last bucket counts everything slower.
+histogram_buckets=16
+
+
+class Metrics:
+    """
+    Counts of everything the framers and decoders have seen. Keys of the per-message counters
+    are message names: UBX-xxx-xxx for UBlox, RTCM-nnnn for RTCM, and NMEA-xxx for NMEA.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Zero all counts
+        """
+        self.start_time=time.time()
+        self.frames=Counter()
+        self.frame_bytes=Counter()
+        self.discarded_bytes=0
+        self.skipped_bytes=0
+        self.checksum_failures=Counter()
+        self.decodes=Counter()
+        self.decode_errors=Counter()
+        self.decode_time=Counter()
+        self.decode_histogram={}
+
+    def frame(self,name,length):
+        """
+        Count a packet found by a framer
+
+        :param name: message name
+        :param length: length of complete packet in bytes
+        """
+        self.frames[name]+=1
+        self.frame_bytes[name]+=length
+
+    def discard(self,length):
+        """
+        Count bytes which weren't part of any recognized packet
+        """
+        self.discarded_bytes+=length
+
+    def skip(self,length):
+        """
+        Count bytes of packets skipped because they weren't subscribed to
+        """
+        self.skipped_bytes+=length
+
+    def checksum_failure(self,packet_type):
+        """
+        Count a packet which failed its checksum
+
+        :param packet_type: name of packet type, NMEA, UBLOX, or RTCM
+        """
+        self.checksum_failures[packet_type]+=1
+
+    def decoded(self,name,seconds):
+        """
+        Count a decoded message and how long it took
+        """
+        self.decodes[name]+=1
+        self.decode_time[name]+=seconds
+        histogram=self.decode_histogram.get(name)
+        if histogram is None:
+            histogram=self.decode_histogram[name]=[0]*histogram_buckets
+        histogram[min(int(seconds*1e6).bit_length(),histogram_buckets-1)]+=1
+
+    def decode_error(self,name,exception):
+        """
+        Count a message which raised an exception while being decoded
+        """
+        self.decode_errors[f"{name}: {type(exception).__name__}"]+=1
+
+    def timed(self,name,func,*args):
+        """
+        Call a decoder, counting the message and timing the call
+
+        :param name: message name
+        :param func: decoder to call
+        :param args: passed on to func
+        :return: whatever func returns. Exceptions are counted and passed on.
+        """
+        t0=time.perf_counter()
+        try:
+            result=func(*args)
+        except Exception as e:
+            self.decode_error(name,e)
+            raise
+        self.decoded(name,time.perf_counter()-t0)
+        return result
+
+    def snapshot(self):
+        """
+        :return: dict of all counts, made only of plain dicts, lists, strings, and numbers so
+                 that it can be written as JSON. Decode time histograms have one count per
+                 bucket, with the upper bound of each bucket in histogram_le_us.
+        """
+        return {"time":time.time(),
+                "elapsed":time.time()-self.start_time,
+                "frames":dict(self.frames),
+                "frame_bytes":dict(self.frame_bytes),
+                "total_frames":sum(self.frames.values()),
+                "total_frame_bytes":sum(self.frame_bytes.values()),
+                "discarded_bytes":self.discarded_bytes,
+                "skipped_bytes":self.skipped_bytes,
+                "checksum_failures":dict(self.checksum_failures),
+                "decodes":dict(self.decodes),
+                "decode_errors":dict(self.decode_errors),
+                "decode_time":dict(self.decode_time),
+                "histogram_le_us":[1<<i for i in range(histogram_buckets-1)]+[None],
+                "decode_histogram":{name:list(histogram) for name,histogram in self.decode_histogram.items()}}
+
+
+def enable(metrics=None):
+    """
+    Start collecting metrics
+
+    :param metrics: Metrics to add to, or None for a new one
+    :return: the Metrics being collected
+    """
+    global active
+    active=Metrics() if metrics is None else metrics
+    return active
+
+
+def disable():
+    """
+    Stop collecting metrics
+
+    :return: the Metrics which were being collected, or None
+    """
+    global active
+    result=active
+    active=None
+    return result
+
+
+def dump_periodically(metrics,interval,ouf=None,reset=False):
+    """
+    Write a snapshot of metrics every so often from a background thread
+
+    :param metrics: Metrics to dump
+    :param interval: seconds between dumps
+    :param ouf: text stream to write to, one line of JSON per snapshot, or a function to call
+                with each snapshot dict. Default is standard error.
+    :param reset: If true, counts are zeroed after each dump, so each snapshot covers one interval
+    :return: function to call to stop dumping. A last snapshot is written when it is called.
+    """
+    if ouf is None:
+        ouf=sys.stderr
+    stop=threading.Event()
+    def dump():
+        snapshot=metrics.snapshot()
+        if reset:
+            metrics.reset()
+        if callable(ouf):
+            ouf(snapshot)
+        else:
+            print(json.dumps(snapshot),file=ouf,flush=True)
+    def run():
+        while not stop.wait(interval):
+            dump()
+        dump()
+    thread=threading.Thread(target=run,name="metrics_ublox",daemon=True)
+    thread.start()
+    def stop_dumping():
+        stop.set()
+        thread.join()
+    return stop_dumping
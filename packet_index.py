@@ -0,0 +1,241 @@
+"""
+Sidecar index of the packets in a recorded stream, so that a large log only has to be
+framed once. The index is a flat array of fixed-size records, one per packet, stored
+next to the log with an .idx suffix.
+"""
+import os
+import re
+import struct
+from collections import namedtuple
+
+from parse_ublox import PacketType, ublox_cls_id, get_ublox_desc, map_file, frame_buffer, ublox_ck_batch, rtcm_ck_batch
+
+# Index file header: magic, size of log, modification time of log in ns
+index_header=struct.Struct("<8sQq")
+index_magic=b"UBXIDX01"
+# One record per packet: offset, length, packet type, UBX class, UBX ID or RTCM message number, time of week
+index_record=struct.Struct("<QIBBHI")
+index_entry=namedtuple("index_entry","ofs length packet_type cls id tow")
+# Value of tow in a record when the packet doesn't have a cheaply available time of week
+no_tow=0xffffffff
+
+# RTCM MSM messages which carry GPS-style time of week (DF004 or DF248), ms, in the 30 bits after
+# the message number and station ID. GLONASS (108x) uses day of week plus time of day instead.
+rtcm_tow_msgs=set(range(1071,1078))|set(range(1091,1098))|set(range(1111,1118))
+
+ublox_tow_cache={}
+
+
+def ublox_tow_reader(cls,id):
+    """
+    Figure out where the time of week is in a UBlox packet, if it has one in its fixed header.
+
+    :param cls: class of packet
+    :param id: ID of packet
+    :return: Tuple of struct format, offset in payload, and scale to milliseconds, or None if
+             the packet has no time of week field described in ublox_packets
+    """
+    key=(cls,id)
+    if key not in ublox_tow_cache:
+        reader=None
+        desc=get_ublox_desc(cls,id).packet_desc
+        if desc is not None:
+            types=re.findall(r"\d*[a-zA-Z]",desc.ht[1:])
+            ofs=0
+            for name,type in zip(desc.hn,types):
+                if name=="iTOW":
+                    reader=("<"+type,ofs,1)
+                    break
+                if name=="rcvTow":
+                    reader=("<"+type,ofs,1000)
+                    break
+                ofs+=struct.calcsize("<"+type)
+        ublox_tow_cache[key]=reader
+    return ublox_tow_cache[key]
+
+
+def index_packet(packet_type,ofs,packet):
+    """
+    Make the index record for one packet
+
+    :param packet_type: PacketType of packet
+    :param ofs: offset of packet in log
+    :param packet: complete packet, as produced by frame_buffer()
+    :return: index_entry for the packet. For RTCM packets, id is the message number
+    """
+    cls,id,tow=0,0,no_tow
+    if packet_type==PacketType.UBLOX:
+        cls,id=packet[2],packet[3]
+        reader=ublox_tow_reader(cls,id)
+        if reader is not None:
+            fmt,field_ofs,scale=reader
+            if 6+field_ofs+struct.calcsize(fmt)<=len(packet)-2:
+                tow=int(round(struct.unpack_from(fmt,packet,6+field_ofs)[0]*scale)) & 0xffffffff
+    elif packet_type==PacketType.RTCM and len(packet)>=8:
+        id=(packet[3]<<4) | (packet[4]>>4)
+        if id in rtcm_tow_msgs and len(packet)>=13:
+            tow=int.from_bytes(packet[6:10],"big")>>2 & 0x3fffffff
+    return index_entry(ofs,len(packet),packet_type.value,cls,id,tow)
+
+
+def index_filename(filename):
+    return filename+".idx"
+
+
+class PacketIndex:
+    """
+    Index of every packet in a log. Records are kept packed in one buffer and only
+    unpacked when asked for.
+    """
+    def __init__(self,records,log_size=0,log_mtime=0):
+        """
+        :param records: bytes-like object holding packed index_record structures
+        :param log_size: size of log this index describes, used to check if the index is stale
+        :param log_mtime: modification time of log this index describes, in ns
+        """
+        self.records=records
+        self.log_size=log_size
+        self.log_mtime=log_mtime
+
+    def __len__(self):
+        return len(self.records)//index_record.size
+
+    def __getitem__(self,i):
+        if i<0:
+            i+=len(self)
+        if not 0<=i<len(self):
+            raise IndexError("index out of range")
+        return index_entry._make(index_record.unpack_from(self.records,i*index_record.size))
+
+    def __iter__(self):
+        return map(index_entry._make,index_record.iter_unpack(self.records))
+
+    def select(self,names=None,packet_type=None,tow_min=None,tow_max=None):
+        """
+        Pick out the entries for packets of interest
+
+        :param names: Collection of packets to select. Each can be a UBX name in UBX-xxx-xxx
+                      form, a (cls,id) tuple, or an integer RTCM message number. None selects all.
+        :param packet_type: If not None, only select packets of this PacketType
+        :param tow_min: If not None, only select packets with a time of week at or after this, in ms
+        :param tow_max: If not None, only select packets with a time of week at or before this, in ms
+        :return: Generator of index_entry
+        """
+        ubx_keys=set()
+        rtcm_keys=set()
+        if names is not None:
+            for name in names:
+                if isinstance(name,str):
+                    ubx_keys.add(ublox_cls_id(name))
+                elif isinstance(name,tuple):
+                    ubx_keys.add(name)
+                else:
+                    rtcm_keys.add(name)
+        for entry in self:
+            if packet_type is not None and entry.packet_type!=packet_type.value:
+                continue
+            if names is not None:
+                if entry.packet_type==PacketType.UBLOX.value:
+                    if (entry.cls,entry.id) not in ubx_keys:
+                        continue
+                elif entry.packet_type==PacketType.RTCM.value:
+                    if entry.id not in rtcm_keys:
+                        continue
+                else:
+                    continue
+            if tow_min is not None and (entry.tow==no_tow or entry.tow<tow_min):
+                continue
+            if tow_max is not None and (entry.tow==no_tow or entry.tow>tow_max):
+                continue
+            yield entry
+
+    def save(self,filename):
+        with open(filename,"wb") as ouf:
+            ouf.write(index_header.pack(index_magic,self.log_size,self.log_mtime))
+            ouf.write(self.records)
+
+    @classmethod
+    def load(cls,filename):
+        """
+        Load an index written by save()
+
+        :param filename: name of index file
+        :return: PacketIndex
+        :raises ValueError: if the file isn't an index
+        """
+        with open(filename,"rb") as inf:
+            data=inf.read()
+        if len(data)<index_header.size:
+            raise ValueError(f"{filename} is not a packet index")
+        magic,log_size,log_mtime=index_header.unpack_from(data)
+        if magic!=index_magic or (len(data)-index_header.size)%index_record.size!=0:
+            raise ValueError(f"{filename} is not a packet index")
+        return cls(memoryview(data)[index_header.size:],log_size,log_mtime)
+
+
+def build_index(buf,log_size=0,log_mtime=0,reject_invalid=True):
+    """
+    Frame a whole log and index every packet in it
+
+    :param buf: buffer holding log, as for frame_buffer()
+    :param reject_invalid: If true, packets which fail their checksum are left out of the index
+    :return: PacketIndex
+    """
+    records=bytearray()
+    for packet_type,ofs,packet in frame_buffer(buf,reject_invalid=reject_invalid):
+        records+=index_record.pack(*index_packet(packet_type,ofs,packet))
+    return PacketIndex(records,log_size,log_mtime)
+
+
+def open_indexed(filename,rebuild=False):
+    """
+    Map a log and get its index, from the sidecar file if it is up to date, otherwise
+    by framing the log and writing a new sidecar.
+
+    :param filename: name of log
+    :param rebuild: If true, always rebuild the index
+    :return: Tuple of the mapped log and its PacketIndex
+    """
+    buf=map_file(filename)
+    stat=os.stat(filename)
+    idx_name=index_filename(filename)
+    if not rebuild:
+        try:
+            index=PacketIndex.load(idx_name)
+            if index.log_size==stat.st_size and index.log_mtime==stat.st_mtime_ns:
+                return buf,index
+        except (OSError,ValueError):
+            pass
+    index=build_index(buf,stat.st_size,stat.st_mtime_ns)
+    index.save(idx_name)
+    return buf,index
+
+
+def bad_frames(buf,index):
+    """
+    Check the checksums of all the UBlox and RTCM packets in an index at once. Useful for
+    an index built with reject_invalid=False. Needs NumPy.
+
+    :param buf: mapped log
+    :param index: PacketIndex of log
+    :return: sorted list of offsets of packets whose checksum fails
+    """
+    result=[]
+    for packet_type,ck_batch in ((PacketType.UBLOX,ublox_ck_batch),(PacketType.RTCM,rtcm_ck_batch)):
+        offsets=[entry.ofs for entry in index.select(packet_type=packet_type)]
+        valid=ck_batch(buf,offsets)
+        result+=[ofs for ofs,ok in zip(offsets,valid) if not ok]
+    return sorted(result)
+
+
+def indexed_packets(buf,entries):
+    """
+    Get packets straight from a log by index, without framing
+
+    :param buf: mapped log
+    :param entries: iterable of index_entry, for instance from PacketIndex.select()
+    :return: Generator of the same tuples as frame_buffer()
+    """
+    view=memoryview(buf)
+    for entry in entries:
+        yield PacketType(entry.packet_type),entry.ofs,view[entry.ofs:entry.ofs+entry.length]
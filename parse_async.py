@@ -0,0 +1,108 @@
+"""
+Read packets from receivers over asyncio streams, so that many receivers (for instance
+behind TCP serial servers) can be handled in one event loop. Serial ports can be used
+too, through any library that provides an asyncio StreamReader for them.
+"""
+import asyncio
+import inspect
+import struct
+
+from parse_ublox import Framer, parse_packet, map_file
+
+
+async def ublox_stream(reader,chunk_size=65536,reject_invalid=True,nmea_max=None,subscribe=None):
+    """
+    Frame packets from an asyncio stream as they arrive
+
+    :param reader: asyncio.StreamReader
+    :param chunk_size: maximum number of bytes to read at once
+    :param reject_invalid: If true, packets which fail their checksum are skipped
+    :param nmea_max: Maximum length of an NMEA sentence, or None for no limit
+    :param subscribe: Subscription of packets to return, or None for all packets
+    :return: Async generator of the same tuples as Framer.feed(), ending at end of stream.
+
+    Nothing more is read from the stream until the consumer has taken all the packets
+    from the last read, so a slow consumer holds up the reader, and the stream's flow
+    control passes that back to the sender.
+    """
+    framer=Framer(reject_invalid=reject_invalid,nmea_max=nmea_max,subscribe=subscribe)
+    while True:
+        chunk=await reader.read(chunk_size)
+        if not chunk:
+            return
+        for frame in framer.feed(chunk):
+            yield frame
+
+
+async def handle_stream(reader,callback,decode=True,**kwargs):
+    """
+    Frame and decode a stream, handing each packet to a callback
+
+    :param reader: asyncio.StreamReader
+    :param callback: called with PacketType, offset in stream, and the record from
+                     parse_packet() (or the raw packet if decode is false, or None if
+                     the packet couldn't be decoded). If it returns an awaitable, that
+                     is awaited before going on to the next packet.
+    :param decode: If true, decode each packet before handing it to the callback
+    :param kwargs: passed on to ublox_stream()
+    """
+    async for packet_type,ofs,packet in ublox_stream(reader,**kwargs):
+        if decode:
+            try:
+                packet=parse_packet(packet_type,packet)
+            except (struct.error,AssertionError,ValueError):
+                packet=None
+        result=callback(packet_type,ofs,packet)
+        if inspect.isawaitable(result):
+            await result
+
+
+async def connect_receiver(host,port,callback,decode=True,**kwargs):
+    """
+    Connect to a receiver over TCP and handle its stream until the connection closes
+
+    :param host: host name or address of receiver or serial server
+    :param port: TCP port
+    :param callback: as for handle_stream()
+    """
+    reader,writer=await asyncio.open_connection(host,port)
+    try:
+        await handle_stream(reader,callback,decode,**kwargs)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def connect_receivers(receivers,decode=True,**kwargs):
+    """
+    Handle many receivers at once, until all their connections close
+
+    :param receivers: iterable of (host, port, callback) tuples, one for each receiver
+    :param decode: as for handle_stream()
+    :return: list with one element per receiver, None if its stream ended normally or
+             the exception it failed with. One receiver failing doesn't stop the others.
+    """
+    return await asyncio.gather(*[connect_receiver(host,port,callback,decode,**kwargs)
+                                  for host,port,callback in receivers],return_exceptions=True)
+
+
+async def serve_file(filename,host="127.0.0.1",port=0,chunk_size=4096):
+    """
+    Serve a recorded stream over TCP, sending the whole file to each client that connects.
+    Useful for trying out a stream consumer without a receiver.
+
+    :param filename: name of log to send
+    :param host: address to listen on
+    :param port: port to listen on, 0 to pick a free one
+    :param chunk_size: number of bytes to write at a time
+    :return: asyncio Server. The port actually used is server.sockets[0].getsockname()[1]
+    """
+    buf=map_file(filename)
+    async def send(reader,writer):
+        try:
+            for ofs in range(0,len(buf),chunk_size):
+                writer.write(buf[ofs:ofs+chunk_size])
+                await writer.drain()
+        finally:
+            writer.close()
+    return await asyncio.start_server(send,host,port)
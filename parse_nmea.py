@@ -0,0 +1,233 @@
+"""
+Decode the common NMEA 0183 sentences into typed records. Fields are converted straight
+from the raw bytes, and sentences nobody asked for are dropped before any of their
+fields are looked at.
+"""
+from collections import namedtuple
+
+import metrics_ublox
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for nmea_columns()
+    np=None
+
+
+def nmea_time(field):
+    """hhmmss.ss to seconds since start of day"""
+    return int(field[0:2])*3600+int(field[2:4])*60+float(field[4:])
+
+
+def nmea_latlon(field,hemi):
+    """(d)ddmm.mmmm and N/S/E/W to signed degrees"""
+    value=float(field)
+    deg=value//100
+    result=deg+(value-100*deg)/60
+    return -result if hemi in (b'S',b'W') else result
+
+
+def nmea_str(field):
+    return str(field,encoding='ascii')
+
+
+# Sentence formatter (without talker) to description and list of fields. Each field is:
+#  * name of field in record
+#  * number of comma-separated fields it uses
+#  * conversion function, taking that many fields as bytes. Empty fields are None instead,
+#    and the function isn't called.
+#  * units of converted value, or None if there are none
+# The last entry may instead have a tuple of names ending in [N]. Those fields repeat, one
+# name per field, to the end of the sentence, and the record has a list of values for each.
+nmea_table={
+    "GGA":("Global positioning system fix data",[
+        ("time",      1, nmea_time,   "s"),
+        ("lat",       2, nmea_latlon, "deg"),
+        ("lon",       2, nmea_latlon, "deg"),
+        ("quality",   1, int,         None),
+        ("numSV",     1, int,         None),
+        ("HDOP",      1, float,       None),
+        ("alt",       1, float,       "m"),
+        ("altUnit",   1, nmea_str,    None),
+        ("sep",       1, float,       "m"),
+        ("sepUnit",   1, nmea_str,    None),
+        ("diffAge",   1, float,       "s"),
+        ("diffStation",1,nmea_str,    None)]),
+    "RMC":("Recommended minimum data",[
+        ("time",      1, nmea_time,   "s"),
+        ("status",    1, nmea_str,    None),
+        ("lat",       2, nmea_latlon, "deg"),
+        ("lon",       2, nmea_latlon, "deg"),
+        ("spd",       1, float,       "knots"),
+        ("cog",       1, float,       "deg"),
+        ("date",      1, nmea_str,    None),
+        ("mv",        1, float,       "deg"),
+        ("mvEW",      1, nmea_str,    None),
+        ("posMode",   1, nmea_str,    None),
+        ("navStatus", 1, nmea_str,    None)]),
+    "GLL":("Latitude and longitude, with time of position fix and status",[
+        ("lat",       2, nmea_latlon, "deg"),
+        ("lon",       2, nmea_latlon, "deg"),
+        ("time",      1, nmea_time,   "s"),
+        ("status",    1, nmea_str,    None),
+        ("posMode",   1, nmea_str,    None)]),
+    "VTG":("Course over ground and ground speed",[
+        ("cogt",      1, float,       "deg"),
+        ("cogtUnit",  1, nmea_str,    None),
+        ("cogm",      1, float,       "deg"),
+        ("cogmUnit",  1, nmea_str,    None),
+        ("sogn",      1, float,       "knots"),
+        ("sognUnit",  1, nmea_str,    None),
+        ("sogk",      1, float,       "km/h"),
+        ("sogkUnit",  1, nmea_str,    None),
+        ("posMode",   1, nmea_str,    None)]),
+    "GSA":("GNSS DOP and active satellites",[
+        ("opMode",    1, nmea_str,    None),
+        ("navMode",   1, int,         None),
+        ("svid1",     1, int,         None),
+        ("svid2",     1, int,         None),
+        ("svid3",     1, int,         None),
+        ("svid4",     1, int,         None),
+        ("svid5",     1, int,         None),
+        ("svid6",     1, int,         None),
+        ("svid7",     1, int,         None),
+        ("svid8",     1, int,         None),
+        ("svid9",     1, int,         None),
+        ("svid10",    1, int,         None),
+        ("svid11",    1, int,         None),
+        ("svid12",    1, int,         None),
+        ("PDOP",      1, float,       None),
+        ("HDOP",      1, float,       None),
+        ("VDOP",      1, float,       None),
+        ("systemId",  1, int,         None)]),
+    "GSV":("GNSS satellites in view",[
+        ("numMsg",    1, int,         None),
+        ("msgNum",    1, int,         None),
+        ("numSV",     1, int,         None),
+        (("svid[N]","elv[N]","az[N]","cno[N]"),4,int,None)]),
+}
+
+# Everything about a sentence type that doesn't depend on the contents of any one sentence
+nmea_desc=namedtuple("nmea_desc","sentence desc names layout units repeat record")
+nmea_desc_cache={}
+
+
+def get_nmea_desc(sentence):
+    """
+    Get the compiled description of a sentence type, compiling it the first time it is seen.
+
+    :param sentence: sentence formatter, without talker, like "GGA"
+    :return: nmea_desc, or None if the sentence isn't in nmea_table:
+      * sentence, desc -- formatter and description
+      * names -- names of fields in record, not including talker and the repeating fields
+      * layout -- list of (index of first comma-separated field, number of fields, conversion) for each name
+      * units -- list of units for each name
+      * repeat -- None, or (names, index of first field, fields per repeat, conversion) for the repeating part
+      * record -- namedtuple class that parse_nmea() returns for this sentence
+    """
+    if sentence in nmea_desc_cache:
+        return nmea_desc_cache[sentence]
+    if sentence not in nmea_table:
+        nmea_desc_cache[sentence]=None
+        return None
+    desc,fields=nmea_table[sentence]
+    names=[]
+    layout=[]
+    units=[]
+    repeat=None
+    i_field=1
+    for name,width,conv,unit in fields:
+        if isinstance(name,tuple):
+            repeat=([x[:-3] for x in name],i_field,width,conv)
+        else:
+            names.append(name)
+            layout.append((i_field,width,conv))
+            units.append(unit)
+        i_field+=width
+    record_names=["talker"]+names+([] if repeat is None else repeat[0])
+    record=namedtuple(f"NMEA_{sentence}"," ".join(record_names))
+    result=nmea_desc(sentence,desc,names,layout,units,repeat,record)
+    nmea_desc_cache[sentence]=result
+    return result
+
+
+def sentence_id(packet):
+    """
+    :param packet: complete sentence as bytes-like object, starting with $
+    :return: formatter of sentence as str, like "GGA". Proprietary sentences ($P...) give "P"
+             followed by the manufacturer code, like "PUBX".
+    """
+    if packet[1]==ord('P'):
+        return str(bytes(packet[1:5]),encoding='ascii',errors='replace')
+    return str(bytes(packet[3:6]),encoding='ascii',errors='replace')
+
+
+def parse_nmea(packet,subscribe=None):
+    """
+    Parse an NMEA sentence
+
+    :param packet: complete sentence as bytes-like object, from the $ to the end of the
+                   line, as returned by frame_buffer(). The checksum isn't checked here.
+    :param subscribe: None to parse all sentences in nmea_table, or a collection of
+                      formatters (like {"GGA","RMC"}) to parse. Other sentences are skipped
+                      without decoding anything.
+    :return: namedtuple with a talker element (like "GN") and one element per field, or
+             None if the sentence is skipped or not in nmea_table. Empty fields are None.
+             Repeating fields (like the satellites in GSV) are lists.
+    """
+    if metrics_ublox.active is not None:
+        return metrics_ublox.active.timed("NMEA-"+sentence_id(packet),decode_nmea,packet,subscribe)
+    return decode_nmea(packet,subscribe)
+
+
+def decode_nmea(packet,subscribe=None):
+    """
+    Does the work of parse_nmea(), without collecting metrics
+    """
+    sentence=sentence_id(packet)
+    if subscribe is not None and sentence not in subscribe:
+        return None
+    desc=get_nmea_desc(sentence)
+    if desc is None:
+        return None
+    packet=bytes(packet)
+    star=packet.rfind(b'*')
+    fields=(packet[:star] if star>=0 else packet.rstrip()).split(b',')
+    n_fields=len(fields)
+    values=[nmea_str(fields[0][1:3])]
+    for i_field,width,conv in desc.layout:
+        if i_field+width>n_fields or len(fields[i_field])==0:
+            values.append(None)
+        elif width==1:
+            values.append(conv(fields[i_field]))
+        else:
+            values.append(conv(*fields[i_field:i_field+width]))
+    if desc.repeat is not None:
+        names,i_first,width,conv=desc.repeat
+        columns=[[] for name in names]
+        for i_rep in range(i_first,n_fields-width+1,width):
+            for column,field in zip(columns,fields[i_rep:i_rep+width]):
+                column.append(conv(field) if len(field)>0 else None)
+        values+=columns
+    return desc.record._make(values)
+
+
+def nmea_columns(records):
+    """
+    Turn a list of records of the same sentence type, from parse_nmea(), into columns
+
+    :param records: iterable of records
+    :return: dict keyed on field name. Numeric fields are NumPy float arrays with NaN
+             for empty fields, if NumPy is available. Other fields, and all fields
+             without NumPy, are lists.
+    """
+    records=list(records)
+    if len(records)==0:
+        return {}
+    result={}
+    for i_field,name in enumerate(records[0]._fields):
+        column=[record[i_field] for record in records]
+        if np is not None and all(x is None or isinstance(x,(int,float)) for x in column):
+            column=np.array([np.nan if x is None else x for x in column],dtype=np.float64)
+        result[name]=column
+    return result
@@ -0,0 +1,184 @@
+"""
+Parse a large recorded stream using several processes. The log is split into chunks at
+packet boundaries, each chunk is framed and decoded in a worker process, and the results
+come back in file order.
+"""
+import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from parse_ublox import PacketType, map_file, next_sync, sync_markers, frame_at, frame_buffer, \
+    parse_packet, get_ublox_desc
+from parse_rtcm import get_rtcm_desc
+from parse_nmea import sentence_id, get_nmea_desc
+
+# Maps of logs already open in this (worker) process, keyed on filename
+worker_maps={}
+
+
+def find_boundary(buf,pos,end):
+    """
+    Find a packet boundary to split a log at
+
+    :param buf: mapped log
+    :param pos: position to start looking at
+    :param end: position to stop looking at
+    :return: first position at or after pos, and before end, where a UBlox or RTCM packet
+             with a valid checksum starts, and is followed immediately by another valid
+             packet or the end of the log. Returns end if there is no such position.
+
+    NMEA sentences aren't used as boundaries, since their 8-bit checksum is too easy to
+    match by accident. Requiring a second packet to follow right away makes it very
+    unlikely that the boundary is actually a packet-shaped piece of some other packet.
+    """
+    view=memoryview(buf)
+    data_end=len(buf)
+    cache=[-1]*len(sync_markers)
+    while True:
+        pos=next_sync(buf,pos,end,cache)
+        if pos>=end:
+            return end
+        packet_type,length=frame_at(buf,view,pos,data_end)
+        if packet_type in (PacketType.UBLOX,PacketType.RTCM):
+            after=pos+length
+            if after>=data_end or frame_at(buf,view,after,data_end)[0] is not None:
+                return pos
+        pos+=1
+
+
+def split_log(buf,chunk_size,index=None):
+    """
+    Split a log into chunks of roughly equal size, at packet boundaries
+
+    :param buf: mapped log
+    :param chunk_size: approximate size of each chunk in bytes
+    :param index: PacketIndex of log, used to pick boundaries if given, otherwise
+                  they are found with find_boundary()
+    :return: Generator of (start,end) tuples covering the whole log
+    """
+    size=len(buf)
+    start=0
+    if index is not None:
+        for entry in index:
+            if entry.ofs-start>=chunk_size:
+                yield start,entry.ofs
+                start=entry.ofs
+    else:
+        while start+chunk_size<size:
+            boundary=find_boundary(buf,start+chunk_size,size)
+            if boundary>=size:
+                break
+            yield start,boundary
+            start=boundary
+    yield start,size
+
+
+def decode_chunk(filename,start,end,subscribe=None):
+    """
+    Frame and decode one chunk of a log. Runs in a worker process.
+
+    :return: list with one tuple per packet. Records can't be pickled since their classes are
+             made on the fly, so the field values are sent back bare to be put back
+             together by rebuild():
+      * value of PacketType
+      * offset of packet
+      * length of packet
+      * field values, None if the packet type isn't described, or the exception raised if
+        the packet couldn't be decoded
+    """
+    if filename not in worker_maps:
+        worker_maps[filename]=map_file(filename)
+    buf=worker_maps[filename]
+    result=[]
+    for packet_type,ofs,packet in frame_buffer(buf,start,end,subscribe=subscribe):
+        try:
+            parsed=parse_packet(packet_type,packet)
+        except (struct.error,AssertionError,ValueError) as e:
+            #These exceptions pickle fine, so send back the error itself
+            result.append((packet_type.value,ofs,len(packet),e))
+            continue
+        if parsed is None:
+            values=None
+        elif packet_type==PacketType.UBLOX:
+            # Leave off cls, id, name, payload, and desc, but keep n_rep
+            values=tuple(parsed[:-6])+(parsed.n_rep,)
+        elif packet_type==PacketType.RTCM:
+            # Leave off units and fmts
+            values=tuple(parsed[:-2])
+        else:
+            values=tuple(parsed)
+        result.append((packet_type.value,ofs,len(packet),values))
+    return result
+
+
+def rebuild(view,packet_type,ofs,length,values,errors=False):
+    """
+    Put a record sent back by decode_chunk() back together
+
+    :param view: memoryview of the log, so that UBlox payloads can be views into it
+    :param errors: If true, packets which couldn't be decoded get the exception raised
+                   instead of None
+    :return: Tuple of PacketType, offset, and the same record parse_ublox(), parse_rtcm(),
+             or parse_nmea() would have returned (None if it isn't described or couldn't be decoded)
+    """
+    packet_type=PacketType(packet_type)
+    packet=view[ofs:ofs+length]
+    if isinstance(values,Exception):
+        return packet_type,ofs,values if errors else None
+    if values is None:
+        return packet_type,ofs,None
+    if packet_type==PacketType.UBLOX:
+        desc=get_ublox_desc(packet[2],packet[3])
+        parsed=desc.record._make(values[:-1]+(desc.cls,desc.id,desc.name,values[-1],packet[6:-2],desc.packet_desc))
+    elif packet_type==PacketType.RTCM:
+        desc=get_rtcm_desc(values[0])
+        parsed=desc.record._make(values+(desc.units,desc.fmts))
+    else:
+        parsed=get_nmea_desc(sentence_id(packet)).record._make(values)
+    return packet_type,ofs,parsed
+
+
+def parse_parallel(filename,workers=None,chunk_size=1<<24,index=None,max_in_flight=None,subscribe=None,
+                   with_packets=False,errors=False):
+    """
+    Parse a whole log with a pool of worker processes
+
+    :param filename: name of log
+    :param workers: number of worker processes, None for one per CPU
+    :param chunk_size: approximate size of the piece of log handed to a worker at once
+    :param index: PacketIndex of log, to split it at indexed packets instead of searching for boundaries
+    :param max_in_flight: maximum number of chunks being decoded or waiting to be consumed
+                          at once, which bounds memory use. Default is twice the number of workers.
+    :param subscribe: Subscription of packets to decode, or None for all packets
+    :param with_packets: If true, also include a memoryview of each packet in the log
+    :param errors: If true, packets which couldn't be decoded get the exception raised
+                   (struct.error, AssertionError, or ValueError) instead of None
+    :return: Generator of tuples, in file order:
+      * PacketType of packet
+      * offset of packet in log
+      * complete packet, only if with_packets is true
+      * record from parse_ublox(), parse_rtcm(), or parse_nmea(), or None if the packet
+        isn't described or couldn't be decoded (or the exception, if errors is true)
+    """
+    if workers is None:
+        workers=os.cpu_count()
+    if max_in_flight is None:
+        max_in_flight=2*workers
+    buf=map_file(filename)
+    view=memoryview(buf)
+    def results(future):
+        for result in future.result():
+            if with_packets:
+                packet_type,ofs,parsed=rebuild(view,*result,errors=errors)
+                yield packet_type,ofs,view[ofs:ofs+result[2]],parsed
+            else:
+                yield rebuild(view,*result,errors=errors)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending=deque()
+        for start,end in split_log(buf,chunk_size,index):
+            pending.append(pool.submit(decode_chunk,filename,start,end,subscribe))
+            if len(pending)>=max_in_flight:
+                yield from results(pending.popleft())
+        while len(pending)>0:
+            yield from results(pending.popleft())
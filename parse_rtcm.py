@@ -1,6 +1,14 @@
 from collections import namedtuple
 from enum import Enum
 
+import metrics_ublox
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for the array decoding options
+    np=None
+
 
 class GLOdow(Enum):
     SUN=0
@@ -124,186 +132,440 @@ def get_bigend_bits(payload, b0, length, signed, verbose):
     :param signed: True if the number is interpreted as a signed two's complement value
     :return: integer value
     """
-    b1 = b0 + length - 1
-    done = False
-    result = 0
-    while not done:
-        B0 = b0 // 8  # Byte that bit 0 is in
-        B1 = b1 // 8  # Byte that bit 1 is in
-        if B1 > B0:  # Not on the last byte yet
-            bb0 = b0 % 8  # starting point in current byte
-            bb1 = 7  # end of current byte
-        else:
-            bb0 = b0 % 8
-            bb1 = b1 % 8
-        width = bb1 - bb0 + 1
-        mask = (1 << width)-1
-        shift=7-bb1
-        result<<=width
-        this_result=(payload[B0]>>shift) & mask
-        result=result|this_result
-        b0=(B0+1)*8
-        done=(b0>=b1)
+    B0 = b0 // 8  # Byte that bit 0 is in
+    B1 = (b0 + length + 7) // 8  # Byte after the one the last bit is in
+    assert B1<=len(payload), "Field runs past end of payload"
+    result = (int.from_bytes(payload[B0:B1], "big") >> (B1*8 - b0 - length)) & ((1 << length) - 1)
     signed_result = result
     if signed:
         cutoff=1<<(length-1)
-        if result>cutoff:
+        if result>=cutoff:
             signed_result=result-2*cutoff
     if verbose: print(f"{signed_result:d}  0x{result:x}  {result:0{length}b}")
     return signed_result
 
 
-def parse_rtcm_field(payload,bitPos,df,verbose):
-    if df<0:
-        if verbose: print(f"payload bitpos: {bitPos:4d}   reserved")
-        value = get_bigend_bits(payload, bitPos, -df, False, verbose)
-        bitPos -= df  # advance (subtract a negative number of) bits
-        name,value,unit,fmt=None,None,None,None
-    else:
+def enum_bits(bitmask,width):
+    """
+    List the set bits of a mask, numbering them from the MSB of a field of the given width,
+    starting at 1. Only the set bits are visited.
+    """
+    result=[]
+    while bitmask!=0:
+        low=bitmask & -bitmask
+        result.append(width-low.bit_length()+1)
+        bitmask^=low
+    result.reverse()
+    return result
+
+
+def compile_plan(dfs, bitPos=0):
+    """
+    Compile a list of data fields at fixed positions into an extraction plan
+
+    :param dfs: list of data field numbers, negative for that many reserved bits
+    :param bitPos: bit position of the first field
+    :return: tuple of the plan and the bit position after the last field. The plan has one
+             tuple per named field:
+      * end -- bit position after the last bit of the field
+      * mask -- mask of width of field
+      * sign -- value of sign bit if field is signed, 0 if not
+      * scale -- scale factor, function, or None, as in df_table
+    """
+    plan=[]
+    for df in dfs:
+        if df<0:
+            bitPos-=df
+            continue
         (name, bits, signed, scale, unit, fmt) = df_table[df]
-        if verbose: print(f"payload bitpos: {bitPos:4d}   width: {bits:2d}  name: {name}   ")
-        value = get_bigend_bits(payload, bitPos, bits, signed, verbose)
-        bitPos += bits
+        bitPos+=bits
+        plan.append((bitPos,(1<<bits)-1,(1<<(bits-1)) if signed else 0,scale))
+    return plan,bitPos
+
+
+def compile_columns(dfs):
+    """
+    Compile a list of data fields which each repeat once per satellite or per cell into an
+    extraction plan. Reserved fields are included, since they take up space in every repeat.
+
+    :param dfs: list of data field numbers, negative for that many reserved bits
+    :return: list with one tuple per field: width, mask, sign bit (0 if unsigned), scale,
+             and True if the field is reserved and its values should be dropped
+    """
+    columns=[]
+    for df in dfs:
+        if df<0:
+            columns.append((-df,(1<<-df)-1,0,None,True))
+        else:
+            (name, bits, signed, scale, unit, fmt) = df_table[df]
+            columns.append((bits,(1<<bits)-1,(1<<(bits-1)) if signed else 0,scale,False))
+    return columns
+
+
+def scale_value(value,scale):
+    if scale is None:
+        return value
+    if callable(scale):
+        return scale(value)
+    return scale*value
+
+
+def run_plan(value,total,plan):
+    """
+    Extract the fields in a plan from compile_plan()
+
+    :param value: whole payload as one big-endian integer
+    :param total: number of bits in payload
+    :param plan: plan from compile_plan()
+    :return: list of scaled values
+    """
+    assert total>=plan[-1][0], "Message too short"
+    result=[]
+    for end,mask,sign,scale in plan:
+        x=(value>>(total-end)) & mask
+        if x & sign:
+            x-=sign<<1
+        result.append(x if scale is None else scale_value(x,scale))
+    return result
+
+
+def run_columns(value,total,bitPos,columns,n):
+    """
+    Extract the fields in a plan from compile_columns()
+
+    :param value: whole payload as one big-endian integer
+    :param total: number of bits in payload
+    :param bitPos: bit position of start of first field
+    :param columns: plan from compile_columns()
+    :param n: number of repeats of each field
+    :return: tuple of list of columns, one for each non-reserved field and each with n
+             scaled values, and bit position after the last field
+    """
+    result=[]
+    for width,mask,sign,scale,reserved in columns:
+        block_bits=width*n
+        bitPos+=block_bits
+        if reserved:
+            continue
+        assert total>=bitPos, "Message too short"
+        block=(value>>(total-bitPos)) & ((1<<block_bits)-1)
+        column=[(block>>shift) & mask for shift in range(block_bits-width,-1,-width)]
+        if sign:
+            column=[x-(sign<<1) if x & sign else x for x in column]
         if callable(scale):
-            value = scale(value)
+            column=[scale(x) for x in column]
         elif scale is not None:
-            value = scale * value
+            column=[scale*x for x in column]
+        result.append(column)
+    return result,bitPos
 
-    return name,value,unit,fmt,bitPos
 
+# Everything about an RTCM message type that doesn't depend on the contents of any one message
+rtcm_desc=namedtuple("rtcm_desc","msgNum dfs names units fmts record plan bits sat_plan sig_plan array_record")
+rtcm_desc_cache={}
 
-def popcount(bitmask):
-    count=0
-    while bitmask!=0:
-        count=count+(bitmask & 1)
-        bitmask=bitmask>>1
-    return count
 
+def get_rtcm_desc(msgNum):
+    """
+    Get the compiled description of an RTCM message type, compiling it the first time
+    it is seen.
 
-def enum_bits(bitmask,width):
-    result=[]
-    while bitmask!=0:
-        if (bitmask & 1):
-            result.append(width)
-        bitmask=bitmask>>1
-        width-=1
-    return sorted(result)
-
-
-def parse_msm7(payload, msgNum, verbose):
-    times,satext,sigID=MSM7_ids[msgNum]
-    names = []
-    values = []
-    units = []
-    fmts = []
-    bitPos=0
-    for df in MSM_header[0]:
-        name, value, unit, fmt, bitPos = parse_rtcm_field(payload, bitPos, df, verbose)
-        if name is not None:
-            names.append(name)
-            values.append(value)
-            units.append(unit)
-            fmts.append(fmt)
-    for df in times:
-        name, value, unit, fmt, bitPos = parse_rtcm_field(payload, bitPos, df, verbose)
-        if name is not None:
-            names.append(name)
-            values.append(value)
-            units.append(unit)
-            fmts.append(fmt)
-    for df in MSM_header[1]:
-        name, value, unit, fmt, bitPos = parse_rtcm_field(payload, bitPos, df, verbose)
-        if name is not None:
-            names.append(name)
-            values.append(value)
-            units.append(unit)
-            fmts.append(fmt)
-    satmask=values[names.index("satmask")]
-    sigmask=values[names.index("sigmask")]
-    Nsig=popcount(sigmask)
-    Nsat=popcount(satmask)
-    X=Nsig*Nsat
-    hdrBits=169+X
+    :param msgNum: RTCM message number
+    :return: rtcm_desc with the following elements, or None if the message isn't described
+             in rtcm_table or MSM7_ids:
+      * msgNum -- as passed in
+      * dfs -- list of data fields in the message, in order. For MSM7 messages, the
+               cell mask is between the header and satellite fields and isn't listed.
+      * names, units, fmts -- lists with one element per named (non-reserved) field
+      * record -- namedtuple class that parse_rtcm() returns for this message type
+      * plan -- compile_plan() of the fields at fixed positions (all of them, or the MSM header)
+      * bits -- bit position after the fields in plan
+      * sat_plan, sig_plan -- compile_columns() of the MSM satellite and signal fields,
+                              or None if not an MSM message
+      * array_record -- namedtuple class that parse_rtcm(arrays=True) returns for this
+                        message type, or None if not an MSM message
+    """
+    if msgNum in rtcm_desc_cache:
+        return rtcm_desc_cache[msgNum]
+    sat_plan,sig_plan,array_record=None,None,None
+    if msgNum in MSM7_ids:
+        times,satext,sigID=MSM7_ids[msgNum]
+        header=MSM_header[0]+list(times)+MSM_header[1]
+        sat_dfs=MSM7_sat_record[0]+list(satext)+MSM7_sat_record[1]
+        dfs=header+sat_dfs+MSM7_sig_record
+        plan,bits=compile_plan(header)
+        sat_plan=compile_columns(sat_dfs)
+        sig_plan=compile_columns(MSM7_sig_record)
+    elif msgNum in rtcm_table:
+        dfs=rtcm_table[msgNum][3]
+        plan,bits=compile_plan(dfs)
+    else:
+        rtcm_desc_cache[msgNum]=None
+        return None
+    fields=[df_table[df] for df in dfs if df>=0]
+    names=[field.name for field in fields]
+    units=[field.unit for field in fields]
+    fmts=[field.fmt for field in fields]
+    record=namedtuple(f"msg{msgNum:04d}"," ".join(names)+" units fmts")
+    if sat_plan is not None:
+        array_record=namedtuple(f"msg{msgNum:04d}",
+                                " ".join(names)+" prns sigs cellmask cell_prn cell_sig units fmts")
+    result=rtcm_desc(msgNum,dfs,names,units,fmts,record,plan,bits,sat_plan,sig_plan,array_record)
+    rtcm_desc_cache[msgNum]=result
+    return result
+
+
+def precompile_rtcm():
+    """
+    Compile the description of every message in rtcm_table and MSM7_ids now, rather than
+    the first time each one is seen.
+    """
+    for msgNum in list(MSM7_ids)+list(rtcm_table):
+        get_rtcm_desc(msgNum)
+
+
+def parse_msm_cells(value, total, desc, sigID):
+    """
+    Work out the satellites and cells of an MSM message from its masks
+
+    :param value: whole payload as one big-endian integer
+    :param total: number of bits in payload
+    :param desc: rtcm_desc of message
+    :param sigID: signal ID enum of the constellation
+    :return: tuple of header values, prns, sigs, cells (list of (prn,sig)), and
+             bit position after the cell mask
+    """
+    values=run_plan(value, total, desc.plan)
+    satmask=values[desc.names.index("satmask")]
+    sigmask=values[desc.names.index("sigmask")]
     prns=enum_bits(satmask,64)
     sigs=[sigID(x) for x in enum_bits(sigmask,32)]
-    # DF396 - GNSS Cell Mask
-    Ncell=0
-    cellmask={}
+    Nsig=len(sigs)
+    Nsat=len(prns)
+    # DF396 - GNSS Cell Mask, Nsig bits for each satellite
+    X=Nsig*Nsat
+    bitPos=desc.bits+X
+    assert total>=bitPos, "Message too short"
+    cellmask=(value>>(total-bitPos)) & ((1<<X)-1)
     cells=[]
-    for prn in prns:
-        col=get_bigend_bits(payload, bitPos, Nsig, False, verbose)
-        bitPos+=Nsig
-        this_sigs=enum_bits(col,Nsig)
-        for sig in this_sigs:
+    for i_sat,prn in enumerate(prns):
+        col=(cellmask>>(Nsig*(Nsat-1-i_sat))) & ((1<<Nsig)-1)
+        for sig in enum_bits(col,Nsig):
             cells.append((prn,sigs[sig-1]))
-        cellmask[prn]=sigs
-        Ncell+=popcount(col)
+    return values,prns,sigs,cells,bitPos
+
+
+def unpack_columns(bits,bitPos,columns,n):
+    """
+    Extract the fields in a plan from compile_columns() into NumPy arrays, all the
+    values of each field at once
+
+    :param bits: NumPy array with one element per bit of payload, from np.unpackbits()
+    :param bitPos: bit position of start of first field
+    :param columns: plan from compile_columns()
+    :param n: number of repeats of each field
+    :return: tuple of list of arrays, one for each non-reserved field, and bit position after
+             the last field. Fields scaled by a number are float arrays, bool fields are bool
+             arrays, and fields with other scale functions (like enums) are left as integer codes.
+    """
+    result=[]
+    for width,mask,sign,scale,reserved in columns:
+        block_bits=width*n
+        bitPos+=block_bits
+        if reserved:
+            continue
+        assert len(bits)>=bitPos, "Message too short"
+        weights=np.left_shift(1,np.arange(width-1,-1,-1,dtype=np.int64))
+        column=bits[bitPos-block_bits:bitPos].reshape(n,width).astype(np.int64) @ weights
+        if sign:
+            column=np.where(column & sign,column-(sign<<1),column)
+        if scale is bool:
+            column=column.astype(bool)
+        elif scale is not None and not callable(scale):
+            column=column*scale
+        result.append(column)
+    return result,bitPos
+
+
+def parse_msm7_arrays(payload, msgNum):
+    """
+    Parse an MSM7 message into NumPy arrays. The header fields are the same as parse_msm7(),
+    but satellite and signal fields are arrays in mask order instead of dicts. Alongside are:
+      * prns -- array of satellite numbers, one for each element of the satellite fields
+      * sigs -- array of signal ID codes in the signal mask
+      * cellmask -- DF396 cell mask, bool array with one row per satellite and one column per signal
+      * cell_prn, cell_sig -- satellite number and signal ID code of each element of the signal fields
+    """
+    if np is None:
+        raise ImportError("NumPy is required for arrays=True")
+    desc=get_rtcm_desc(msgNum)
+    values=run_plan(int.from_bytes(payload,"big"), len(payload)*8, desc.plan)
+    bits=np.unpackbits(np.frombuffer(payload,dtype=np.uint8))
+    satmask=bits[desc.bits-64-32:desc.bits-32]
+    sigmask=bits[desc.bits-32:desc.bits]
+    prns=np.flatnonzero(satmask)+1
+    sigs=np.flatnonzero(sigmask)+1
+    # DF396 - GNSS Cell Mask, len(sigs) bits for each satellite
+    bitPos=desc.bits+len(prns)*len(sigs)
+    assert len(bits)>=bitPos, "Message too short"
+    cellmask=bits[desc.bits:bitPos].reshape(len(prns),len(sigs)).astype(bool)
+    cell_sat,cell_sig=np.nonzero(cellmask)
+    columns,bitPos=unpack_columns(bits, bitPos, desc.sat_plan, len(prns))
+    values+=columns
+    columns,bitPos=unpack_columns(bits, bitPos, desc.sig_plan, len(cell_sat))
+    values+=columns
+    return desc.array_record._make(tuple(values)+(prns,sigs,cellmask,prns[cell_sat],sigs[cell_sig],desc.units,desc.fmts))
+
+
+def parse_msm7(payload, msgNum):
+    sigID=MSM7_ids[msgNum][2]
+    desc=get_rtcm_desc(msgNum)
+    value=int.from_bytes(payload,"big")
+    total=len(payload)*8
+    values,prns,sigs,cells,bitPos=parse_msm_cells(value, total, desc, sigID)
     # Satellite records
-    for df in MSM7_sat_record[0]:
-        value={}
-        for prn in prns:
-            name, value[prn], unit, fmt, bitPos = parse_rtcm_field(payload, bitPos, df, verbose)
-        if name is not None:
-            names.append(name)
-            values.append(value)
-            units.append(unit)
-            fmts.append(fmt)
-    for df in satext:
-        value={}
-        for prn in prns:
-            name, value[prn], unit, fmt, bitPos = parse_rtcm_field(payload, bitPos, df, verbose)
-        if name is not None:
-            names.append(name)
-            values.append(value)
-            units.append(unit)
-            fmts.append(fmt)
-    for df in MSM7_sat_record[1]:
-        value={}
-        for prn in prns:
-            name, value[prn], unit, fmt, bitPos = parse_rtcm_field(payload, bitPos, df, verbose)
-        if name is not None:
-            names.append(name)
-            values.append(value)
-            units.append(unit)
-            fmts.append(fmt)
+    columns,bitPos=run_columns(value, total, bitPos, desc.sat_plan, len(prns))
+    values+=[dict(zip(prns,column)) for column in columns]
     # Signal records
-    for df in MSM7_sig_record:
-        value={}
-        for cell in cells:
-            name, value[cell], unit, fmt, bitPos = parse_rtcm_field(payload, bitPos, df, verbose)
-        if name is not None:
-            names.append(name)
-            values.append(value)
-            units.append(unit)
-            fmts.append(fmt)
-    return namedtuple(f"msg{values[names.index('msgNum')]:04d}",
-                      " ".join(names)+" units fmts")._make(tuple(values)+(units,fmts))
-
-
-def parse_rtcm(packet, verbose=False):
-    payload=packet[3:-3]
-    msgNum=get_bigend_bits(payload,0,12,False, verbose)
+    columns,bitPos=run_columns(value, total, bitPos, desc.sig_plan, len(cells))
+    values+=[dict(zip(cells,column)) for column in columns]
+    return desc.record._make(tuple(values)+(desc.units,desc.fmts))
+
+
+def unscale_value(value,scale):
+    """
+    Turn a field value back into its raw integer, the inverse of scale_value()
+
+    :param value: scaled value of field
+    :param scale: scale factor, function, or None, as in df_table. Functions other than
+                  bool and enums can't be inverted, so values for them must be raw already.
+    :return: raw integer value
+    """
+    if isinstance(value,Enum):
+        return value.value
+    if scale is None or callable(scale):
+        return int(value)
+    return int(round(value/scale))
+
+
+def put_fields(acc,dfs,values):
+    """
+    Append the fields of a message to a bit accumulator
+
+    :param acc: tuple of accumulated bits as a big-endian integer, and number of bits
+    :param dfs: list of data fields, as in rtcm_table. Reserved fields (negative) are zero.
+    :param values: list with one scaled value per non-reserved field
+    :return: updated accumulator
+    """
+    value,total=acc
+    i_value=0
+    for df in dfs:
+        if df<0:
+            value=value<<-df
+            total-=df
+            continue
+        (name, bits, signed, scale, unit, fmt) = df_table[df]
+        raw=unscale_value(values[i_value],scale)
+        i_value+=1
+        if signed:
+            assert -(1<<(bits-1))<=raw<(1<<(bits-1)), f"{name} out of range"
+        else:
+            assert 0<=raw<(1<<bits), f"{name} out of range"
+        value=(value<<bits) | (raw & ((1<<bits)-1))
+        total+=bits
+    return value,total
+
+
+def encode_rtcm(msgNum,values):
+    """
+    Build the payload of an RTCM message from field values, using the same descriptions
+    that parse_rtcm() decodes it with. Wrap the result with parse_ublox.rtcm_frame()
+    to get a complete packet.
+
+    :param msgNum: RTCM message number
+    :param values: dict of scaled field values keyed on field name, like record._asdict() of a
+                   record from parse_rtcm(). msgNum doesn't need to be included. For MSM7
+                   messages, satellite fields are dicts keyed on prn and signal fields are dicts
+                   keyed on (prn,sig), as parse_msm7() returns. The satellite and cell masks
+                   are worked out from the keys of these dicts. The signal mask is too, plus
+                   any signals in the sigmask value, if given.
+    :return: bytes of payload, padded with zeros to a whole number of bytes
+    """
+    desc=get_rtcm_desc(msgNum)
+    if desc is None:
+        raise ValueError(f"No description for RTCM message {msgNum}")
+    values={**values,"msgNum":msgNum}
     if msgNum in MSM7_ids:
-        return parse_msm7(payload, msgNum, verbose)
-    bitPos=0
-    if msgNum in rtcm_table:
-        name, desc, repeat, dfs=rtcm_table[msgNum]
-        names = []
-        values = []
-        units = []
-        fmts = []
-        for df in dfs:
-            name, value, unit, fmt, bitPos=parse_rtcm_field(payload,bitPos,df,verbose)
-            if name is not None:
-                names.append(name)
-                values.append(value)
-                units.append(unit)
-                fmts.append(fmt)
-        return namedtuple(f"msg{msgNum:04d}"," ".join(names)+" units fmts")._make(tuple(values)+(units,fmts))
+        times,satext,sigID=MSM7_ids[msgNum]
+        cells=set(values[df_table[MSM7_sig_record[0]].name])
+        prns=sorted(set(values[df_table[MSM7_sat_record[0][0]].name])|set([prn for prn,sig in cells]))
+        sigs=set([sig for prn,sig in cells])|set([sigID(x) for x in enum_bits(values.get("sigmask",0),32)])
+        sigs=sorted(sigs,key=lambda sig:sig.value)
+        values["satmask"]=sum([1<<(64-prn) for prn in prns])
+        values["sigmask"]=sum([1<<(32-sig.value) for sig in sigs])
+        header=MSM_header[0]+list(times)+MSM_header[1]
+        acc=put_fields((0,0),header,[values[df_table[df].name] for df in header if df>=0])
+        # DF396 - GNSS Cell Mask
+        cellmask=0
+        for prn in prns:
+            for sig in sigs:
+                cellmask=(cellmask<<1) | ((prn,sig) in cells)
+        acc=((acc[0]<<(len(prns)*len(sigs))) | cellmask,acc[1]+len(prns)*len(sigs))
+        cells=[(prn,sig) for prn in prns for sig in sigs if (prn,sig) in cells]
+        for keys,dfs in ((prns,MSM7_sat_record[0]+list(satext)+MSM7_sat_record[1]),(cells,MSM7_sig_record)):
+            for df in dfs:
+                column=values[df_table[df].name] if df>=0 else {}
+                acc=put_fields(acc,[df]*len(keys),[column[key] for key in keys if key in column])
     else:
-        return None
+        acc=put_fields((0,0),desc.dfs,[values[df_table[df].name] for df in desc.dfs if df>=0])
+    value,total=acc
+    pad=(-total) % 8
+    return (value<<pad).to_bytes((total+pad)//8,"big")
+
+
+def print_rtcm(msg):
+    """
+    Print the fields of a message parsed by parse_rtcm(), one per line
+    """
+    for name,value,unit in zip(msg._fields,msg,msg.units):
+        print(f"{name:>15s}: {value}"+(' '+unit if unit is not None else ''))
 
 
+def parse_rtcm(packet, verbose=False, arrays=False):
+    """
+    Parse an RTCM packet
+
+    :param packet: complete packet, including preamble, length, and CRC
+    :param verbose: If true, print the fields after parsing
+    :param arrays: If true, MSM7 satellite and signal fields are decoded into NumPy
+                   arrays by parse_msm7_arrays() instead of dicts
+    :return: namedtuple of the message fields, or None if the message type isn't described
+    """
+    if metrics_ublox.active is not None:
+        return metrics_ublox.active.timed(f"RTCM-{(packet[3]<<4) | (packet[4]>>4)}",decode_rtcm,packet,verbose,arrays)
+    return decode_rtcm(packet,verbose,arrays)
+
+
+def decode_rtcm(packet, verbose=False, arrays=False):
+    """
+    Does the work of parse_rtcm(), without collecting metrics
+    """
+    payload=packet[3:-3]
+    msgNum=get_bigend_bits(payload,0,12,False, False)
+    desc=get_rtcm_desc(msgNum)
+    if desc is None:
+        return None
+    if msgNum in MSM7_ids:
+        if arrays:
+            result=parse_msm7_arrays(payload, msgNum)
+        else:
+            result=parse_msm7(payload, msgNum)
+    else:
+        values=run_plan(int.from_bytes(payload,"big"), len(payload)*8, desc.plan)
+        result=desc.record._make(tuple(values)+(desc.units,desc.fmts))
+    if verbose: print_rtcm(result)
+    return result
+
 if __name__ == "__main__":
     print("%03x" % get_bigend_bits(b'\x12\x34\x56',  0, 12, False, True))
     print("%04x" % get_bigend_bits(b'\x12\x34\x56',  4, 16, False, True))
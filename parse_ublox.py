@@ -2,15 +2,27 @@
 Code to parse a stream of data from a UBlox reveiver (not necessarily just UBlox packets)
 and do useful things with the data.
 """
+import json
+import mmap
+import os
 import re
 import struct
+import sys
 from collections import namedtuple
-from functools import partial
+from functools import partial, lru_cache
 from struct import unpack
 from enum import Enum
-import traceback
+from itertools import accumulate
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for the array decoding options
+    np=None
 
 from parse_rtcm import parse_rtcm
+from parse_nmea import parse_nmea, sentence_id
+import metrics_ublox
 
 
 class PacketType(Enum):
@@ -19,36 +31,211 @@ class PacketType(Enum):
     RTCM = 3
 
 
-def ublox_ck_valid(payload:bytes,ck_a:int,ck_b:int):
+# Packets at least this long have their checksum calculated with NumPy, if available
+ublox_ck_numpy_min=256
+
+
+def ublox_checksum(body):
+    """
+    Calculate the 8-bit Fletcher checksum used by UBlox packets (UBX manual 3.4)
+
+    :param body: bytes-like object covering the class, ID, length, and payload of the packet
+    :return: Tuple of CK_A and CK_B
+
+    CK_A is the sum of all the bytes, and CK_B is the sum of all the running values of
+    CK_A, which is the same as weighting each byte by how many bytes are left including
+    itself. Both are taken mod 256, which commutes with the sums, so they are only reduced at the end.
+    """
+    if np is not None and len(body)>=ublox_ck_numpy_min:
+        data=np.frombuffer(body,dtype=np.uint8).astype(np.uint64)
+        ck_a=int(data.sum())
+        ck_b=int(np.dot(np.arange(len(data),0,-1,dtype=np.uint64),data))
+    else:
+        ck_a=sum(body)
+        ck_b=sum(accumulate(body))
+    return ck_a & 0xff, ck_b & 0xff
+
+
+def ublox_ck_valid(body:bytes,ck_a:int,ck_b:int):
     """
     Check the checksum of a UBlox packet
 
-    :param payload:
-    :param ck_a:
-    :param ck_b:
-    :return:
+    :param body: bytes-like object covering the class, ID, length, and payload of the packet,
+                 IE everything between the sync characters and the checksum
+    :param ck_a: first checksum byte from packet
+    :param ck_b: second checksum byte from packet
+    :return: True if the checksum matches
+    """
+    return ublox_checksum(body)==(ck_a,ck_b)
+
+
+def ublox_ck_batch(buf,offsets):
+    """
+    Check the checksums of many UBlox packets at once. Needs NumPy.
+
+    :param buf: buffer holding the packets, as for frame_buffer()
+    :param offsets: sequence of offsets in buf of the start (sync characters) of each packet
+    :return: NumPy array of bool, True for each packet with a valid checksum. Packets which
+             run off the end of the buffer are invalid.
+
+    Each checksum is a difference of prefix sums over the packet bodies, calculated
+    in uint64. Everything is mod 256 in the end, so wraparound in the prefix sums doesn't matter.
+    Packets are handled a batch at a time so that the temporary arrays stay bounded.
+    """
+    if np is None:
+        raise ImportError("NumPy is required for ublox_ck_batch()")
+    data=np.frombuffer(buf,dtype=np.uint8)
+    offsets=np.asarray(offsets,dtype=np.int64)
+    valid=np.zeros(len(offsets),dtype=bool)
+    in_buf=np.flatnonzero(offsets+8<=len(data))
+    lengths=data[offsets[in_buf]+4].astype(np.int64) | (data[offsets[in_buf]+5].astype(np.int64)<<8)
+    fits=offsets[in_buf]+lengths+8<=len(data)
+    in_buf=in_buf[fits]
+    lengths=lengths[fits]
+    body_lens=lengths+4
+    ends=np.cumsum(body_lens)
+    batch_bytes=1<<24
+    i0=0
+    while i0<len(in_buf):
+        i1=max(int(np.searchsorted(ends,(ends[i0]-body_lens[i0])+batch_bytes,side="right")),i0+1)
+        which=in_buf[i0:i1]
+        these_lens=body_lens[i0:i1]
+        body_end=np.cumsum(these_lens)
+        body_start=body_end-these_lens
+        total=int(body_end[-1])
+        src_pos=np.repeat(offsets[which]+2-body_start,these_lens)+np.arange(total)
+        x=data[src_pos].astype(np.uint64)
+        s1=np.zeros(total+1,dtype=np.uint64)
+        np.cumsum(x,out=s1[1:])
+        s2=np.zeros(total+1,dtype=np.uint64)
+        np.cumsum(x*np.arange(total,dtype=np.uint64),out=s2[1:])
+        ck_a=s1[body_end]-s1[body_start]
+        ck_b=body_end.astype(np.uint64)*ck_a-(s2[body_end]-s2[body_start])
+        ck_pos=offsets[which]+6+lengths[i0:i1]
+        valid[which]=((ck_a & 0xff)==data[ck_pos]) & ((ck_b & 0xff)==data[ck_pos+1])
+        i0=i1
+    return valid
+
+
+def xor_bytes(data):
     """
-    return True
+    XOR all the bytes of some data together
+
+    :param data: bytes-like object
+    :return: XOR of all bytes, 0 if there are none
+
+    The data is read as one big integer and folded in half repeatedly, XORing the
+    top half into the bottom, so the work is done a whole integer at a time.
+    """
+    x=int.from_bytes(data,"little")
+    width=len(data)
+    while width>1:
+        half=(width+1)//2
+        x=(x ^ (x>>(8*half))) & ((1<<(8*half))-1)
+        width=half
+    return x
 
 
 def nmea_ck_valid(packet:bytes,has_checksum):
     """
     Check the checksum of an NMEA packet
 
-    :param packet:
-    :return:
+    :param packet: complete sentence, from the $ through the CR LF
+    :param has_checksum: True if the sentence has a checksum, in which case it ends with *hh CR LF
+    :return: True if the checksum is valid, or if the sentence doesn't have one
+    """
+    if not has_checksum:
+        return True
+    try:
+        ck=int(bytes(packet[-4:-2]),16)
+    except ValueError:
+        return False
+    return xor_bytes(packet[1:-5])==ck
+
+
+def make_crc24q_table():
     """
-    return True
+    Build the byte-at-a-time lookup table for CRC-24Q (RTCM 10403.3 section 4.2),
+    polynomial 0x1864CFB, no reflection, initial value and final XOR of zero.
+
+    :return: tuple of 256 table entries
+    """
+    table=[]
+    for byte in range(256):
+        crc=byte<<16
+        for bit in range(8):
+            crc<<=1
+            if crc & 0x1000000:
+                crc^=0x1864cfb
+        table.append(crc & 0xffffff)
+    return tuple(table)
+
+
+crc24q_table=make_crc24q_table()
+
+
+def crc24q(data,crc=0):
+    """
+    Calculate the CRC-24Q of some data
+
+    :param data: bytes-like object
+    :param crc: CRC of data preceding this, to calculate a CRC in pieces
+    :return: 24-bit CRC
+    """
+    table=crc24q_table
+    for byte in data:
+        crc=((crc & 0xffff)<<8) ^ table[(crc>>16) ^ byte]
+    return crc
 
 
 def rtcm_ck_valid(packet:bytes):
     """
     Check the checksum of an RTCM packet
 
-    :param packet:
-    :return:
+    :param packet: complete packet, including preamble, length, payload, and CRC
+    :return: True if the CRC matches. Running the CRC over the transmitted CRC as well as
+             the data leaves zero if and only if they match, so that's what is checked.
+    """
+    return crc24q(packet)==0
+
+
+def rtcm_ck_batch(buf,offsets):
     """
-    return True
+    Check the CRCs of many RTCM packets at once. Needs NumPy.
+
+    :param buf: buffer holding the packets, as for frame_buffer()
+    :param offsets: sequence of offsets in buf of the start (preamble) of each packet
+    :return: NumPy array of bool, True for each packet with a valid CRC. Packets which
+             run off the end of the buffer are invalid.
+
+    All the CRCs are run in parallel, one byte position at a time. Packets are sorted
+    longest first, so the ones still running at any position are always a leading slice.
+    """
+    if np is None:
+        raise ImportError("NumPy is required for rtcm_ck_batch()")
+    data=np.frombuffer(buf,dtype=np.uint8)
+    offsets=np.asarray(offsets,dtype=np.int64)
+    valid=np.zeros(len(offsets),dtype=bool)
+    in_buf=np.flatnonzero(offsets+3<=len(data))
+    lengths=((data[offsets[in_buf]+1].astype(np.int64) & 0x03)<<8 | data[offsets[in_buf]+2])+6
+    fits=offsets[in_buf]+lengths<=len(data)
+    in_buf=in_buf[fits]
+    lengths=lengths[fits]
+    order=np.argsort(-lengths,kind="stable")
+    in_buf=in_buf[order]
+    lengths=lengths[order]
+    starts=offsets[in_buf]
+    table=np.array(crc24q_table,dtype=np.uint32)
+    crc=np.zeros(len(in_buf),dtype=np.uint32)
+    n_active=len(in_buf)
+    for i_byte in range(int(lengths[0]) if len(lengths)>0 else 0):
+        while lengths[n_active-1]<=i_byte:
+            n_active-=1
+        active=crc[:n_active]
+        byte=data[starts[:n_active]+i_byte]
+        crc[:n_active]=((active & 0xffff)<<8) ^ table[(active>>16) ^ byte]
+    valid[in_buf]=crc==0
+    return valid
 
 
 def next_packet(inf,reject_invalid=True,nmea_max=None):
@@ -72,8 +259,13 @@ def next_packet(inf,reject_invalid=True,nmea_max=None):
             result+=inf.read(2)
             has_checksum=True
         if not reject_invalid or nmea_ck_valid(result,has_checksum):
+            if metrics_ublox.active is not None:
+                metrics_ublox.active.frame(packet_name(PacketType.NMEA,result),len(result))
             return PacketType.NMEA, str(result,encoding='cp437').strip()
         else:
+            if metrics_ublox.active is not None:
+                metrics_ublox.active.checksum_failure("NMEA")
+                metrics_ublox.active.discard(len(result))
             return None, None
     elif header_peek[0]==0xb5:
         #Start of UBlox header
@@ -86,15 +278,22 @@ def next_packet(inf,reject_invalid=True,nmea_max=None):
             length=unpack('<H',header[4:6])[0]
             payload=inf.read(length)
             ck=inf.read(2)
-            if not reject_invalid or ublox_ck_valid(payload,ck[0],ck[1]):
+            if not reject_invalid or ublox_ck_valid(header[2:]+payload,ck[0],ck[1]):
+                if metrics_ublox.active is not None:
+                    metrics_ublox.active.frame(packet_name(PacketType.UBLOX,header),len(payload)+8)
                 return PacketType.UBLOX, header+payload+ck
             else:
                 #Checksum failed. Advanced past the whole packet, but packet is not returned.
+                if metrics_ublox.active is not None:
+                    metrics_ublox.active.checksum_failure("UBLOX")
+                    metrics_ublox.active.discard(len(payload)+8)
                 return None,None
         else:
             #Not a ublox packet. We wish we could push back, but won't for now. Know that
             #the stream has been advanced by two bytes. If there is a stray 0xb5 (mu) before
             #an actual packet, this will cause the packet to be missed.
+            if metrics_ublox.active is not None:
+                metrics_ublox.active.discard(2)
             return None,None
     elif header_peek[0]==0xd3:
         # Start of RTCM packet. One byte preamble, two-byte big-endian length (only 10 ls bits
@@ -104,45 +303,422 @@ def next_packet(inf,reject_invalid=True,nmea_max=None):
         length=unpack('>H',header[1:3])[0] & 0x3ff
         payload=inf.read(length)
         ck=inf.read(3)
-        if not reject_invalid or ublox_ck_valid(payload,ck[0],ck[1]):
+        if not reject_invalid or rtcm_ck_valid(header+payload+ck):
+            if metrics_ublox.active is not None:
+                metrics_ublox.active.frame(packet_name(PacketType.RTCM,header+payload),len(payload)+6)
             return PacketType.RTCM, header+payload+ck
         else:
             #Checksum failed. Advanced past the whole packet, but packet is not returned.
+            if metrics_ublox.active is not None:
+                metrics_ublox.active.checksum_failure("RTCM")
+                metrics_ublox.active.discard(len(payload)+6)
             return None,None
     else:
         # Not either kind of packet we can recognize. Return None, and know that the
         # data stream has had one byte consumed.
+        if metrics_ublox.active is not None:
+            metrics_ublox.active.discard(1)
         return None,None
 
 
+# Byte sequences which can start a packet, in the same order as the cache kept by next_sync()
+sync_markers=(b'$',b'\xb5\x62',b'\xd3')
+
+
+def map_file(filename):
+    """
+    Map a recorded stream into memory, read-only. The file itself is closed
+    immediately, the map stays valid as long as something refers to it.
+
+    :param filename: Name of file to map
+    :return: mmap object, or empty bytes if the file is empty (zero-length files can't be mapped)
+    """
+    with open(filename,"rb") as inf:
+        try:
+            return mmap.mmap(inf.fileno(),0,access=mmap.ACCESS_READ)
+        except ValueError:
+            return b''
+
+
+def next_sync(buf,pos,end,cache):
+    """
+    Find the next position in the buffer that could start a packet.
+
+    :param buf: Buffer to search, anything with a bytes-style find() method (bytes, bytearray, mmap)
+    :param pos: Position to start searching at
+    :param end: Position to stop searching at
+    :param cache: List with one position per entry in sync_markers, initially all -1. Each
+                  marker is only searched for again once pos has moved past its last hit, so
+                  a rare marker costs one scan of the buffer instead of one scan per packet.
+    :return: Position of the next sync marker, or end if there are no more
+    """
+    best=end
+    for i_marker,marker in enumerate(sync_markers):
+        hit=cache[i_marker]
+        if hit<pos:
+            hit=buf.find(marker,pos,end)
+            if hit<0:
+                hit=end
+            cache[i_marker]=hit
+        if hit<best:
+            best=hit
+    return best
+
+
+class Subscription:
+    """
+    Set of packet types of interest. The framers check packets against it using just
+    their headers, and skip the rest without copying or checking them.
+    """
+    def __init__(self,names):
+        """
+        :param names: collection of packets to subscribe to. Each can be:
+          * a UBX name in UBX-xxx-xxx form, or a (cls,id) tuple
+          * an integer RTCM message number
+          * an NMEA sentence formatter, like "GGA" (any talker) or "PUBX"
+        """
+        self.ublox=set()
+        self.rtcm=set()
+        self.nmea=set()
+        for name in names:
+            if isinstance(name,int):
+                self.rtcm.add(name)
+            elif isinstance(name,tuple):
+                self.ublox.add((name[0]<<8) | name[1])
+            elif name.startswith("UBX-"):
+                cls,id=ublox_cls_id(name)
+                self.ublox.add((cls<<8) | id)
+            else:
+                self.nmea.add(name.encode('ascii'))
+
+    def wants(self,buf,ofs,packet_type):
+        """
+        Check if a packet is subscribed to
+
+        :param buf: buffer holding packet
+        :param ofs: offset of start of packet. Enough of the packet must be in the buffer to
+                    identify it: 4 bytes for UBX, 5 for RTCM, 6 for NMEA.
+        :param packet_type: PacketType of packet
+        :return: True if the packet is subscribed to
+        """
+        if packet_type==PacketType.UBLOX:
+            return ((buf[ofs+2]<<8) | buf[ofs+3]) in self.ublox
+        elif packet_type==PacketType.RTCM:
+            return ((buf[ofs+3]<<4) | (buf[ofs+4]>>4)) in self.rtcm
+        if buf[ofs+1]==0x50:
+            return bytes(buf[ofs+1:ofs+5]) in self.nmea
+        return bytes(buf[ofs+3:ofs+6]) in self.nmea
+
+
+# First bytes of sync_markers
+sync_leads=(0x24,0xb5,0xd3)
+
+
+def frame_at(buf,view,ofs,end,reject_invalid=True,nmea_max=None,subscribe=None):
+    """
+    Figure out how long the packet starting at a given position is.
+
+    :param buf: Buffer holding the stream, anything with a bytes-style find() method
+    :param view: memoryview of buf, used to hand slices to the checksum functions without copying
+    :param ofs: Position of the first byte of the candidate packet
+    :param end: Position one past the last valid byte in the buffer
+    :param reject_invalid: If true, packets which fail their checksum are rejected
+    :param nmea_max: Maximum length of an NMEA sentence, or None for no limit
+    :param subscribe: Subscription, or None to accept all packets
+    :return: Tuple of packet type and packet length:
+      * (PacketType, length) for a complete valid packet
+      * (None, 0) if the buffer ends before the packet does, and more data is needed to decide
+      * (None, 1) if this isn't the start of a valid packet. Only the first byte is
+        considered consumed, so a real packet hiding right after it isn't lost.
+      * (None, length) with length>1 for a valid packet which isn't subscribed to, and
+        should be skipped over whole.
+
+    A UBX or RTCM packet which isn't subscribed to is skipped without checking its checksum, as
+    long as it is followed immediately by something that looks like the start of another packet
+    (or the end of the buffer). Otherwise it gets checked like any other packet, so that a
+    false sync can't skip over real packets. NMEA sentences are always checked, since a stray $
+    followed by a * somewhere later is too easy to come across.
+    """
+    lead=buf[ofs]
+    if lead==0x24:
+        #Looks like an NMEA packet, look for the asterisk
+        limit=end if nmea_max is None else min(end,ofs+nmea_max)
+        star=buf.find(b'*',ofs,limit)
+        if star<0:
+            return (None,1) if limit<end else (None,0)
+        #Either 0D0A or checksum follows the asterisk
+        if star+3>end:
+            return None,0
+        if buf[star+1]==0x0d and buf[star+2]==0x0a:
+            length=star+3-ofs
+            has_checksum=False
+        else:
+            if star+5>end:
+                return None,0
+            length=star+5-ofs
+            has_checksum=True
+        wanted=subscribe is None or (length>=6 and subscribe.wants(buf,ofs,PacketType.NMEA))
+        if not reject_invalid or nmea_ck_valid(view[ofs:ofs+length],has_checksum):
+            return (PacketType.NMEA,length) if wanted else (None,length)
+        if metrics_ublox.active is not None:
+            metrics_ublox.active.checksum_failure("NMEA")
+        return None,1
+    elif lead==0xb5:
+        if ofs+2>end:
+            return None,0
+        if buf[ofs+1]!=0x62:
+            return None,1
+        if ofs+6>end:
+            return None,0
+        length=buf[ofs+4] | (buf[ofs+5]<<8)
+        if ofs+length+8>end:
+            return None,0
+        ck=ofs+6+length
+        wanted=subscribe is None or subscribe.wants(buf,ofs,PacketType.UBLOX)
+        if not wanted and (ck+2>=end or buf[ck+2] in sync_leads):
+            return None,length+8
+        if not reject_invalid or ublox_ck_valid(view[ofs+2:ck],buf[ck],buf[ck+1]):
+            return (PacketType.UBLOX,length+8) if wanted else (None,length+8)
+        if metrics_ublox.active is not None:
+            metrics_ublox.active.checksum_failure("UBLOX")
+        return None,1
+    elif lead==0xd3:
+        # One byte preamble, two-byte big-endian length (only 10 ls bits
+        # are significant), n-byte payload, three byte CRC
+        if ofs+3>end:
+            return None,0
+        if buf[ofs+1] & 0xfc:
+            #Reserved bits must be zero
+            return None,1
+        length=((buf[ofs+1] & 0x03)<<8) | buf[ofs+2]
+        if ofs+length+6>end:
+            return None,0
+        wanted=subscribe is None or (length>=2 and subscribe.wants(buf,ofs,PacketType.RTCM))
+        if not wanted and (ofs+length+6>=end or buf[ofs+length+6] in sync_leads):
+            return None,length+6
+        if not reject_invalid or rtcm_ck_valid(view[ofs:ofs+length+6]):
+            return (PacketType.RTCM,length+6) if wanted else (None,length+6)
+        if metrics_ublox.active is not None:
+            metrics_ublox.active.checksum_failure("RTCM")
+        return None,1
+    return None,1
+
+
+def packet_name(packet_type,buf,ofs=0):
+    """
+    Name a packet without decoding it
+
+    :param packet_type: PacketType of packet
+    :param buf: buffer holding packet
+    :param ofs: offset of start of packet in buf
+    :return: UBX-xxx-xxx for UBlox, RTCM-nnnn for RTCM, or NMEA-xxx for NMEA
+    """
+    if packet_type==PacketType.UBLOX:
+        return get_ublox_desc(buf[ofs+2],buf[ofs+3]).name
+    elif packet_type==PacketType.RTCM:
+        return f"RTCM-{(buf[ofs+3]<<4) | (buf[ofs+4]>>4)}"
+    return "NMEA-"+sentence_id(buf[ofs:ofs+6])
+
+
+def frame_buffer(buf,start=0,end=None,reject_invalid=True,nmea_max=None,subscribe=None):
+    """
+    Split a buffer holding a recorded stream into packets, without copying any of them.
+
+    :param buf: Buffer to frame, anything with a bytes-style find() method (bytes, bytearray,
+                or the mmap returned by map_file())
+    :param start: Position to start framing at
+    :param end: Position to stop framing at, or None for the end of the buffer. Only packets
+                which start before end are returned, but they may run past it, so that a
+                buffer can be framed in pieces split at packet boundaries.
+    :param reject_invalid: If true, packets which fail their checksum are skipped
+    :param nmea_max: Maximum length of an NMEA sentence, or None for no limit
+    :param subscribe: Subscription of packets to return, or None for all packets
+    :return: Generator of tuples:
+      * PacketType of packet
+      * Offset of start of packet in buf
+      * memoryview of the complete packet (including header and checksum), sharing memory with buf
+
+    Bytes which aren't part of any recognized packet are skipped. A packet
+    truncated by the end of the buffer is not returned.
+    """
+    view=memoryview(buf)
+    data_end=len(buf)
+    if end is None:
+        end=data_end
+    cache=[-1]*len(sync_markers)
+    pos=start
+    metrics=metrics_ublox.active
+    while True:
+        sync=next_sync(buf,pos,end,cache)
+        if metrics is not None:
+            metrics.discard(min(sync,end)-pos)
+        pos=sync
+        if pos>=end:
+            return
+        packet_type,length=frame_at(buf,view,pos,data_end,reject_invalid,nmea_max,subscribe)
+        if packet_type is not None:
+            if metrics is not None:
+                metrics.frame(packet_name(packet_type,buf,pos),length)
+            yield packet_type,pos,view[pos:pos+length]
+        else:
+            if length==0:
+                #The packet seems to run past the end of the buffer, but the whole buffer is
+                #already here, so this is a false sync (like a bogus length field or a stray $),
+                #or a packet cut off at the end of the log. Either way, keep looking after it.
+                length=1
+            if metrics is not None:
+                if length==1:
+                    metrics.discard(1)
+                else:
+                    metrics.skip(length)
+        pos+=length
+
+
+class Framer:
+    """
+    Incremental framer for live streams (serial ports, sockets, pipes). Feed it
+    whatever chunks the source happens to deliver, and it hands back every packet
+    which has been completed so far. Partial packets are held over until the next
+    feed. Garbage is skipped one byte at a time, so a packet immediately following
+    a stray sync byte or a corrupted packet is still found.
+    """
+    def __init__(self,reject_invalid=True,nmea_max=None,subscribe=None):
+        """
+        :param reject_invalid: If true, packets which fail their checksum are skipped
+        :param nmea_max: Maximum length of an NMEA sentence, or None for no limit
+        :param subscribe: Subscription of packets to return, or None for all packets
+        """
+        self.reject_invalid=reject_invalid
+        self.nmea_max=nmea_max
+        self.subscribe=subscribe
+        self.buf=bytearray()
+        # Stream offset of buf[0]
+        self.base=0
+        # Number of bytes skipped because they weren't part of any valid packet
+        self.discarded=0
+
+    def feed(self,chunk):
+        """
+        Add data to the stream and frame as many packets as possible
+
+        :param chunk: bytes-like object with the next part of the stream, any length
+        :return: List of tuples, one for each packet completed by this chunk:
+          * PacketType of packet
+          * Offset of start of packet in the stream (counting from the first byte ever fed)
+          * bytes of the complete packet (including header and checksum)
+        """
+        buf=self.buf
+        buf+=chunk
+        end=len(buf)
+        frames=[]
+        cache=[-1]*len(sync_markers)
+        pos=0
+        discarded=self.discarded
+        metrics=metrics_ublox.active
+        with memoryview(buf) as view:
+            while True:
+                sync=next_sync(buf,pos,end,cache)
+                if sync>=end and end>pos and buf[end-1]==0xb5:
+                    #The chunk ended between the two UBX sync bytes, keep the first one
+                    sync=end-1
+                    self.discarded+=sync-pos
+                    pos=sync
+                    break
+                self.discarded+=sync-pos
+                pos=sync
+                if pos>=end:
+                    break
+                packet_type,length=frame_at(buf,view,pos,end,self.reject_invalid,self.nmea_max,self.subscribe)
+                if packet_type is not None:
+                    if metrics is not None:
+                        metrics.frame(packet_name(packet_type,buf,pos),length)
+                    frames.append((packet_type,self.base+pos,bytes(view[pos:pos+length])))
+                elif length==0:
+                    #Wait for the rest of the packet
+                    break
+                elif length==1:
+                    self.discarded+=length
+                elif metrics is not None:
+                    metrics.skip(length)
+                pos+=length
+        if metrics is not None:
+            metrics.discard(self.discarded-discarded)
+        # Deleting from the front of a bytearray just moves its start pointer, so
+        # the buffer memory is reused rather than reallocated every chunk.
+        del buf[:pos]
+        self.base+=pos
+        return frames
+
+    def pending(self):
+        """
+        :return: Number of bytes held over waiting for the rest of a packet
+        """
+        return len(self.buf)
+
+
+def frame_stream(inf,chunk_size=65536,reject_invalid=True,nmea_max=None,subscribe=None):
+    """
+    Frame packets from a file-like object as they arrive
+
+    :param inf: Object with a read() method returning bytes, such as an open file,
+                a serial port, or socket.makefile('rb'). If it has read1(), that is
+                used instead, so that a short read doesn't block waiting for a full chunk.
+    :param chunk_size: Maximum number of bytes to ask for in each read
+    :param reject_invalid: If true, packets which fail their checksum are skipped
+    :param nmea_max: Maximum length of an NMEA sentence, or None for no limit
+    :param subscribe: Subscription of packets to return, or None for all packets
+    :return: Generator of the same tuples as Framer.feed(), ending when the stream does
+    """
+    framer=Framer(reject_invalid=reject_invalid,nmea_max=nmea_max,subscribe=subscribe)
+    read=getattr(inf,"read1",inf.read)
+    while True:
+        chunk=read(chunk_size)
+        if not chunk:
+            return
+        yield from framer.feed(chunk)
+
+
         #  x0    x1    x2    x3    x4    x5    x6    x7    x8    x9    xa    xb    xc    xd    xe    xf
 low_sub=('\u2400\u263A\u263b\u2665\u2666\u2663\u2660\u2022\u25d8\u25cb\u25d9\u2642\u2640\u266a\u266b\u263c'+
          '\u25ba\u25c4\u2195\u203c\u00b6\u00a7\u25ac\u21a8\u2191\u2193\u2192\u2190\u221f\u2194\u25b2\u25bc\u2420')
 
 
-def dump_bin(buf,word_len=4, words_per_line=8):
+# Character to show for each byte value in dump_bin(). Control characters and space get the
+# code page 437 glyphs in low_sub, the rest are themselves in ISO 8859-1.
+glyph_table=str.maketrans({i:(low_sub[i] if i<len(low_sub) else chr(i)) for i in range(256)})
+
+
+def format_bin(buf,word_len=4, words_per_line=8):
+    """
+    Format a hex dump of a buffer
+
+    :param buf: bytes-like object to dump
+    :param word_len: number of bytes per word
+    :param words_per_line: number of words per line
+    :return: text of dump, one line for each line_len bytes (plus one), each with the offset,
+             the bytes in hex (in groups of 4), and the bytes as characters
+    """
+    buf=bytes(buf)
     line_len = word_len * words_per_line
-    for i_line in range((len(buf) // line_len)+1):
-        i_line0 = i_line * line_len
-        i_line1 = (i_line + 1) * line_len
-        print(f"{i_line0:04x} - ", end='')
-        for i_byte_in_line, i_byte in enumerate(range(i_line0, i_line1)):
-            if i_byte<len(buf):
-                print(f"{buf[i_byte]:02x}",end='')
-            else:
-                print("  ",end='')
-            if (i_byte_in_line + 1) % 4 == 0:
-                print(" ", end='')
-        print("|",end='')
-        for i_byte_in_line, i_byte in enumerate(range(i_line0, i_line1)):
-            if i_byte < len(buf):
-                if buf[i_byte]<len(low_sub):
-                    print(low_sub[buf[i_byte]],end='')
-                else:
-                    print(str(buf[i_byte:i_byte+1],encoding='iso8859-1'),end='')
-            else:
-                print(" ",end='')
-        print("")
+    hex_len = 2*line_len
+    trailer = " " if line_len % 4 == 0 else ""
+    lines=[]
+    for i_line0 in range(0, (len(buf) // line_len)*line_len+1, line_len):
+        chunk=buf[i_line0:i_line0+line_len]
+        hexs=chunk.hex().ljust(hex_len)
+        lines.append(f"{i_line0:04x} - "+" ".join([hexs[i:i+8] for i in range(0,hex_len,8)])+trailer+"|"+
+                     chunk.decode('iso8859-1').translate(glyph_table).ljust(line_len)+"\n")
+    return "".join(lines)
+
+
+def dump_bin(buf,word_len=4, words_per_line=8, ouf=None):
+    """
+    Print a hex dump of a buffer, as formatted by format_bin()
+
+    :param ouf: text stream to write to, default standard output
+    """
+    (sys.stdout if ouf is None else ouf).write(format_bin(buf,word_len,words_per_line))
+
 
 class GNSS(Enum):
     GPS=0
@@ -404,6 +980,24 @@ ublox_packets={
                  0x36:("SPARTNKEY",)})
 }
 
+def ublox_cls_id(name):
+    """
+    Look up the class and ID of a UBlox packet by name
+
+    :param name: Name of packet in UBX-xxx-xxx format, as produced by parse_ublox()
+    :return: Tuple of class and ID
+    :raises KeyError: if there is no packet of that name in ublox_packets
+    """
+    parts=name.split("-")
+    if len(parts)==3 and parts[0]=="UBX":
+        for cls,(clsname,ids) in ublox_packets.items():
+            if clsname==parts[1]:
+                for id,idtuple in ids.items():
+                    if idtuple[0]==parts[2]:
+                        return cls,id
+    raise KeyError(f"Unknown packet {name}")
+
+
 def fmt_width(fmt):
     match=re.match("( *)[^1-9]*(\d+).*",fmt)
     return len(match.group(1))+int(match.group(2))
@@ -442,6 +1036,11 @@ def compile(field_dict):
       * footer_type: string suitable for handing to struct.unpack, for fields after repeating block
       * footer_scale: list of scales for fields after repeating block
       * footer_units: list of units for fields after repeating block
+      * header_dtype, block_dtype, footer_dtype: NumPy structured dtype matching the struct
+        format of each part, or None if the part is empty or NumPy isn't available
+      * header_vscale, block_vscale, footer_vscale: list of scales suitable for whole
+        columns: None for no scaling, a number to multiply by, or a function that works
+        on arrays. Enum fields have None here, and are left as integer codes.
 
     At parse time, the number of repeats of the repeating block is determined as follows:
 
@@ -451,17 +1050,17 @@ def compile(field_dict):
     d-b-c=m*n
     (d-b-c)/m=n
     """
-    size_dict={"U1":("B",1,"%3d"),
-               "U2":("H",2,"%5d"),
-               "U4":("I",4,"%9d"),
-               "I1":("b",1,"%4d"),
-               "I2":("h",2,"%6d"),
-               "I4":("i",4,"%10d"),
-               "X1":("B",1,"%02x"),
-               "X2":("H",2,"%04x"),
-               "X4":("I",4,"%08x"),
-               "R4":("f",4,"%14.7e"),
-               "R8":("d",8,"%21.14e")}
+    size_dict={"U1":("B",1,"%3d",   "u1"),
+               "U2":("H",2,"%5d",   "<u2"),
+               "U4":("I",4,"%9d",   "<u4"),
+               "I1":("b",1,"%4d",   "i1"),
+               "I2":("h",2,"%6d",   "<i2"),
+               "I4":("i",4,"%10d",  "<i4"),
+               "X1":("B",1,"%02x",  "u1"),
+               "X2":("H",2,"%04x",  "<u2"),
+               "X4":("I",4,"%08x",  "<u4"),
+               "R4":("f",4,"%14.7e","<f4"),
+               "R8":("d",8,"%21.14e","<f8")}
     lengths=[0,0,0]
     fields=[[],[],[]]
     types=["","",""]
@@ -469,6 +1068,8 @@ def compile(field_dict):
     units=[[],[],[]]
     fmts=[[],[],[]]
     widths=[[],[],[]]
+    dtypes=[[],[],[]]
+    vscales=[[],[],[]]
     part=0
     for field_name,(ublox_type,scale,unit,fmt) in field_dict.items():
         if "[N]" in field_name:
@@ -482,15 +1083,20 @@ def compile(field_dict):
         if ublox_type[0:2]=="CH":
             types[part]+=ublox_type[2:]+"s"
             lengths[part]+=int(ublox_type[2:])
+            dtypes[part].append((field_name,"S"+ublox_type[2:]))
         else:
             types[part]+=size_dict[ublox_type][0]
             lengths[part]+=size_dict[ublox_type][1]
+            dtypes[part].append((field_name,size_dict[ublox_type][3]))
         if scale is None:
             scales[part].append(lambda x:x)
+            vscales[part].append(None)
         elif callable(scale):
             scales[part].append(scale)
+            vscales[part].append(None if isinstance(scale,type) and issubclass(scale,Enum) else scale)
         else:
             scales[part].append(partial(lambda s,x:s*x,scale))
+            vscales[part].append(scale)
         units[part].append(unit)
         if fmt is None:
             fmt=size_dict[ublox_type][2]
@@ -507,28 +1113,168 @@ def compile(field_dict):
     header_units,block_units,footer_units=units
     header_format,block_format,footer_format=fmts
     header_widths,block_widths,footer_widths=widths
-    return namedtuple("packet_desc","b m c hn ht hs hu hf hw bn bt bs bu bf bw fn ft fs fu ff fw")._make((b,m,c,
+    header_dtype,block_dtype,footer_dtype=[np.dtype(x) if np is not None and len(x)>0 else None for x in dtypes]
+    header_vscale,block_vscale,footer_vscale=vscales
+    return namedtuple("packet_desc","b m c hn ht hs hu hf hw bn bt bs bu bf bw fn ft fs fu ff fw hd bd fd hv bv fv")._make((b,m,c,
             header_fields,header_types,header_scale,header_units,header_format,header_widths,
             block_fields,block_types,block_scale,block_units,block_format,block_widths,
-            footer_fields, footer_types, footer_scale, footer_units, footer_format,footer_widths))
+            footer_fields, footer_types, footer_scale, footer_units, footer_format,footer_widths,
+            header_dtype,block_dtype,footer_dtype,
+            header_vscale,block_vscale,footer_vscale))
 
 
-def parse_ublox(packet):
+def scale_column(column,vscale):
     """
-    Parse a ublox packet
+    Scale a whole column of raw values at once
 
-    :param packet: bytes array containting full binary packet, including header and checksum
-    :return: namedtuple with name set to name of packet (UBX-xxx-xxx format) and the following elements:
-    * cls -- class of packet
-    * id  -- ID of packet
-    * n_rep -- number of times the repeating block in the packet repeats. Will be None if there is no repeating block.
-    * one element for each field in the packet. Values will be converted (scaled, made into enum, etc)
-      as indicated by the packet description. Fields in a repeating block are lists, one element for each repeat.
+    :param column: NumPy array of raw values
+    :param vscale: Scale as in the header_vscale, block_vscale, or footer_vscale lists from compile()
+    :return: Scaled array. Functions are handed the column as float64, so that things
+             like 2**n don't overflow small integer types.
     """
-    cls=packet[2]
-    id=packet[3]
-    length=len(packet)-8
-    payload=packet[6:-2]
+    if vscale is None:
+        return column
+    if callable(vscale):
+        return vscale(column.astype(np.float64))
+    return column*vscale
+
+
+class LazyField:
+    """
+    Descriptor for one field of a LazyUblox record. The field is decoded and scaled the
+    first time it is read, and the value is cached in the record.
+    """
+    __slots__=("field_name","part","ofs","unpacker","scale","b","m","c")
+
+    def __init__(self,field_name,part,ofs,fmt,scale,packet_desc):
+        """
+        :param field_name: name of field
+        :param part: 0 for header, 1 for repeating block, 2 for footer
+        :param ofs: offset of field from start of its part (or row, in the block)
+        :param fmt: struct format of field
+        :param scale: scale function from packet_desc
+        :param packet_desc: compiled packet description from compile()
+        """
+        self.field_name=field_name
+        self.part=part
+        self.ofs=ofs
+        self.unpacker=struct.Struct("<"+fmt)
+        self.scale=scale
+        self.b,self.m,self.c=packet_desc.b,packet_desc.m,packet_desc.c
+
+    def __get__(self,record,owner):
+        if record is None:
+            return self
+        values=record.values
+        if values is None:
+            values=record.values={}
+        elif self.field_name in values:
+            return values[self.field_name]
+        value=values[self.field_name]=self.decode(record.packet)
+        return value
+
+    def decode(self,packet):
+        """
+        :param packet: complete packet, including header and checksum
+        :return: scaled value of field, or list of values for a field in the repeating block
+        """
+        if self.part==0:
+            return self.scale(self.unpacker.unpack_from(packet,6+self.ofs)[0])
+        elif self.part==2:
+            return self.scale(self.unpacker.unpack_from(packet,len(packet)-2-self.c+self.ofs)[0])
+        d=len(packet)-8
+        assert (d-self.b-self.c) % self.m == 0, "Non-integer number of rows"
+        n_rows=(d-self.b-self.c)//self.m
+        unpack_from=self.unpacker.unpack_from
+        scale=self.scale
+        start=6+self.b+self.ofs
+        return [scale(unpack_from(packet,start+i_row*self.m)[0]) for i_row in range(n_rows)]
+
+
+class LazyUblox:
+    """
+    Packet record which holds on to just the packet, and decodes each field the first
+    time it is read. Has the same elements as the records from parse_ublox(), as attributes
+    rather than tuple items. Each packet type has its own subclass, made by make_lazy().
+    """
+    __slots__=("packet","values")
+    cls=None
+    id=None
+    name=None
+    desc=None
+    _fields=()
+
+    def __init__(self,packet):
+        """
+        :param packet: complete packet, including header and checksum. Kept as is, so pass a
+                       memoryview (as produced by frame_buffer()) to avoid a copy.
+        """
+        self.packet=packet
+        self.values=None
+
+    @property
+    def payload(self):
+        return self.packet[6:-2]
+
+    @property
+    def n_rep(self):
+        if self.desc is None or self.desc.m==0:
+            return 0
+        return (len(self.packet)-8-self.desc.b-self.desc.c)//self.desc.m
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join([f'{field}={getattr(self,field)!r}' for field in self._fields])})"
+
+
+def make_lazy(typename,cls,id,name,packet_desc):
+    """
+    Make the LazyUblox subclass for a packet type
+
+    :param typename: name of class
+    :param cls: class of packet
+    :param id: ID of packet
+    :param name: name of packet in UBX-xxx-xxx format
+    :param packet_desc: compiled packet description from compile(), or None if the packet has no field description
+    :return: subclass of LazyUblox with a LazyField for each field of the packet
+    """
+    attrs={"__slots__":(),"cls":cls,"id":id,"name":name,"desc":packet_desc}
+    fields=[]
+    if packet_desc is not None:
+        parts=((packet_desc.hn,packet_desc.ht,packet_desc.hs),
+               (packet_desc.bn,packet_desc.bt,packet_desc.bs),
+               (packet_desc.fn,packet_desc.ft,packet_desc.fs))
+        for part,(names,types,scales) in enumerate(parts):
+            ofs=0
+            for field_name,fmt,scale in zip(names,re.findall(r"\d*[a-zA-Z]",types[1:]),scales):
+                attrs[field_name]=LazyField(field_name,part,ofs,fmt,scale,packet_desc)
+                fields.append(field_name)
+                ofs+=struct.calcsize("<"+fmt)
+    attrs["_fields"]=tuple(fields)
+    return type(typename,(LazyUblox,),attrs)
+
+
+# Everything about a UBlox packet type that doesn't depend on the contents of any one packet
+ublox_desc=namedtuple("ublox_desc","cls id name packet_desc record lazy")
+ublox_desc_cache={}
+
+
+def get_ublox_desc(cls,id):
+    """
+    Get the compiled description of a UBlox packet type, compiling it the first time
+    it is seen.
+
+    :param cls: class of packet
+    :param id: ID of packet
+    :return: ublox_desc with the following elements:
+      * cls, id -- as passed in
+      * name -- name of packet in UBX-xxx-xxx format
+      * packet_desc -- result of compile() on the field dict, or None if the packet has no field description
+      * record -- namedtuple class that parse_ublox() returns for this packet type
+      * lazy -- LazyUblox subclass that parse_ublox_lazy() returns for this packet type
+    """
+    key=(cls,id)
+    if key in ublox_desc_cache:
+        return ublox_desc_cache[key]
     clsname = f"0x{cls:02x}"
     idname = f"0x{id:02x}"
     packet_desc=None
@@ -540,7 +1286,60 @@ def parse_ublox(packet):
             if len(idtuple)>1:
                 packet_desc=compile(idtuple[1])
     name=f"UBX-{clsname}-{idname}"
-    idname=f"UBX_{clsname}_{idname}"
+    typename=f"UBX_{clsname}_{idname}"
+    field_names=[] if packet_desc is None else packet_desc.hn+packet_desc.bn+packet_desc.fn
+    record=namedtuple(typename," ".join(field_names)+" cls id name n_rep payload desc")
+    lazy=make_lazy("Lazy"+typename,cls,id,name,packet_desc)
+    result=ublox_desc(cls,id,name,packet_desc,record,lazy)
+    ublox_desc_cache[key]=result
+    return result
+
+
+def precompile_ublox():
+    """
+    Compile the description of every packet in ublox_packets now, rather than
+    the first time each one is seen.
+    """
+    for cls,(clsname,ids) in ublox_packets.items():
+        for id in ids:
+            get_ublox_desc(cls,id)
+
+
+def parse_ublox(packet,arrays=False):
+    """
+    Parse a ublox packet
+
+    :param packet: bytes array containting full binary packet, including header and checksum.
+                   May be a memoryview (as produced by frame_buffer()), in which case the
+                   payload field is a view into the same memory rather than a copy.
+    :param arrays: If true, the repeating block is decoded with NumPy in one step instead
+      of row by row, and fields in it are arrays rather than lists. Enum fields in the block
+      are left as integer codes, use enum_column() to convert them.
+    :return: namedtuple with name set to name of packet (UBX-xxx-xxx format) and the following elements:
+    * cls -- class of packet
+    * id  -- ID of packet
+    * n_rep -- number of times the repeating block in the packet repeats. Will be None if there is no repeating block.
+    * one element for each field in the packet. Values will be converted (scaled, made into enum, etc)
+      as indicated by the packet description. Fields in a repeating block are lists, one element for each repeat.
+    If the packet has no description in ublox_packets, desc is None and there are no field elements.
+    The namedtuple class is shared by all packets of the same type.
+    """
+    if metrics_ublox.active is not None:
+        return metrics_ublox.active.timed(get_ublox_desc(packet[2],packet[3]).name,decode_ublox,packet,arrays)
+    return decode_ublox(packet,arrays)
+
+
+def decode_ublox(packet,arrays=False):
+    """
+    Does the work of parse_ublox(), without collecting metrics
+    """
+    cls=packet[2]
+    id=packet[3]
+    payload=packet[6:-2]
+    desc=get_ublox_desc(cls,id)
+    packet_desc=desc.packet_desc
+    if packet_desc is None:
+        return desc.record._make((cls,id,desc.name,0,payload,None))
     if packet_desc.b>0:
         unscaled_header=unpack(packet_desc.ht,payload[0:packet_desc.b])
         header=tuple([scale(field) for field,scale in zip(unscaled_header,packet_desc.hs)])
@@ -554,67 +1353,291 @@ def parse_ublox(packet):
         d = len(payload)
         assert (d-packet_desc.b-packet_desc.c) % packet_desc.m == 0, "Non-integer number of rows"
         n_rows = (d - packet_desc.b - packet_desc.c) // packet_desc.m
-        n_cols=len(packet_desc.bs)
-        # in memory -- the blocks are a tuple of columns, each a list long enough to hold one member
-        # for each row. This means each cell has a double index, the first one being the column index,
-        # second being row. We do it this way so that we can concatenate it with the header and
-        # footer tuple, and hand the combo right off to the _make() method of namedtuple.
-        cols=tuple([[None for x in range(n_rows)] for y in range(n_cols)])
-        for i_row in range(n_rows):
-            unscaled_row=unpack(packet_desc.bt,payload[packet_desc.b+i_row*packet_desc.m:packet_desc.b+i_row*packet_desc.m+packet_desc.m])
-            row=[scale(field) for field,scale in zip(unscaled_row,packet_desc.bs)]
-            for i_col,element in enumerate(row):
-                cols[i_col][i_row]=element
+        if arrays:
+            if np is None:
+                raise ImportError("NumPy is required for arrays=True")
+            rows=np.frombuffer(payload,dtype=packet_desc.bd,count=n_rows,offset=packet_desc.b)
+            cols=tuple([scale_column(rows[name].copy(),vscale) for name,vscale in zip(packet_desc.bn,packet_desc.bv)])
+        else:
+            cols=parse_ublox_block(payload,packet_desc,n_rows)
         if packet_desc.c>0:
             unscaled_footer = unpack(packet_desc.ft, payload[packet_desc.b+packet_desc.m*n_rows:])
-            footer = tuple([scale(field) for field, scale in zip(unscaled_footer, packet_desc.hs)])
+            footer = tuple([scale(field) for field, scale in zip(unscaled_footer, packet_desc.fs)])
         else:
             footer = tuple()
     else:
         cols=tuple()
         footer=tuple()
         n_rows=0
-    returntype=namedtuple(idname," ".join(packet_desc.hn+packet_desc.bn+packet_desc.fn)+" cls id name n_rep payload desc")
-    return returntype._make(header+cols+footer+(cls,id,name,n_rows,payload,packet_desc))
+    return desc.record._make(header+cols+footer+(cls,id,desc.name,n_rows,payload,packet_desc))
+
+
+def parse_ublox_lazy(packet):
+    """
+    Wrap a ublox packet in a record which decodes fields only when they are read
+
+    :param packet: bytes array containing full binary packet, including header and checksum.
+                   Not copied, so if it is a memoryview of a mapped log, the log stays mapped
+                   as long as the record is around.
+    :return: LazyUblox record. Reading a field decodes and scales just that field, and
+             the value is kept for the next read. Fields in a repeating block are lists.
+    """
+    return get_ublox_desc(packet[2],packet[3]).lazy(packet)
+
+
+def parse_ublox_block(payload,packet_desc,n_rows):
+    """
+    Decode the repeating block of a packet row by row
+
+    :param payload: payload of packet
+    :param packet_desc: compiled packet description from compile()
+    :param n_rows: number of times the block repeats
+    :return: tuple of columns, each a list with one scaled element for each row
+    """
+    n_cols=len(packet_desc.bs)
+    # in memory -- the blocks are a tuple of columns, each a list long enough to hold one member
+    # for each row. This means each cell has a double index, the first one being the column index,
+    # second being row. We do it this way so that we can concatenate it with the header and
+    # footer tuple, and hand the combo right off to the _make() method of namedtuple.
+    cols=tuple([[None for x in range(n_rows)] for y in range(n_cols)])
+    for i_row in range(n_rows):
+        unscaled_row=unpack(packet_desc.bt,payload[packet_desc.b+i_row*packet_desc.m:packet_desc.b+i_row*packet_desc.m+packet_desc.m])
+        row=[scale(field) for field,scale in zip(unscaled_row,packet_desc.bs)]
+        for i_col,element in enumerate(row):
+            cols[i_col][i_row]=element
+    return cols
+
+
+def enum_column(packet,field_name):
+    """
+    Convert a repeating block field left as integer codes by parse_ublox(arrays=True) into enums
+
+    :param packet: Packet parsed with arrays=True
+    :param field_name: Name of field, without [N]
+    :return: list of enum values, one for each repeat
+    """
+    enum=packet.desc.bs[packet.desc.bn.index(field_name)]
+    return [enum(int(code)) for code in getattr(packet,field_name)]
+
 
+def ublox_frame(cls,id,payload):
+    """
+    Wrap a payload in a UBlox packet
+
+    :param cls: class of packet
+    :param id: ID of packet
+    :param payload: bytes of payload
+    :return: complete packet, including sync, header, and checksum
+    """
+    body=bytes((cls,id))+struct.pack("<H",len(payload))+payload
+    ck_a,ck_b=ublox_checksum(body)
+    return b'\xb5\x62'+body+bytes((ck_a,ck_b))
+
+
+def rtcm_frame(payload):
+    """
+    Wrap a payload (like one from encode_rtcm()) in an RTCM packet
+
+    :param payload: bytes of payload, up to 1023 bytes
+    :return: complete packet, including preamble, length, and CRC
+    """
+    if len(payload)>0x3ff:
+        raise ValueError(f"RTCM payload too long: {len(payload)} bytes")
+    header=bytes((0xd3,len(payload)>>8,len(payload) & 0xff))
+    return header+payload+crc24q(header+payload).to_bytes(3,"big")
+
+
+def nmea_frame(body):
+    """
+    Wrap the body of an NMEA sentence
+
+    :param body: sentence between the $ and the *, like "GNGGA,181911.00,..."
+    :return: complete sentence as bytes, including checksum and line ending
+    """
+    body=body.encode('ascii') if isinstance(body,str) else bytes(body)
+    return b'$'+body+b'*'+(f"{xor_bytes(body):02X}\r\n").encode('ascii')
+
+
+@lru_cache(maxsize=None)
+def inverse_table(scale,code):
+    """
+    Tabulate a scale function over every raw value of a one-byte field, so it can be inverted
+
+    :param scale: scale function
+    :param code: struct code of field, "B" or "b"
+    :return: tuple of (scaled value, raw value) pairs
+    """
+    raws=range(256) if code=="B" else range(-128,128)
+    return tuple([(scale(raw),raw) for raw in raws])
+
+
+def unscale(value,scale,vscale,code):
+    """
+    Turn a field value back into what is stored in the packet, the inverse of the scaling
+    done by parse_ublox()
+
+    :param value: scaled value of field. Enums may also be given as their integer code.
+    :param scale: scale function, from the hs, bs, or fs list of compile()
+    :param vscale: vector scale, from the hv, bv, or fv list of compile()
+    :param code: struct code of field
+    :return: raw value, ready for struct.pack()
+    :raises ValueError: for a field with a scale function that can't be inverted. Functions
+                        are only inverted for one-byte fields, by picking the closest raw value.
+    """
+    if isinstance(value,Enum):
+        return value.value
+    if code[-1]=="s":
+        return value.encode('ascii') if isinstance(value,str) else bytes(value)
+    if vscale is None:
+        return value
+    if callable(vscale):
+        if code not in ("B","b"):
+            raise ValueError("Can't invert scale function of a multi-byte field")
+        return min(inverse_table(scale,code),key=lambda pair:abs(pair[0]-value))[1]
+    if code in ("f","d"):
+        return value/vscale
+    return int(round(value/vscale))
+
+
+def encode_part(values,names,types,scales,vscales,i_row=None):
+    """
+    Pack the header, one row of the repeating block, or the footer of a UBlox payload
+
+    :param values: dict of scaled values keyed on field name. Fields which aren't in it are zero.
+    :param names, types, scales, vscales: field names, struct format, and scales from compile()
+    :param i_row: index of row in repeating block, or None for header or footer
+    :return: bytes of packed part
+    """
+    raw=[]
+    for name,code,scale,vscale in zip(names,re.findall(r"\d*[a-zA-Z]",types[1:]),scales,vscales):
+        if name in values:
+            value=values[name] if i_row is None else values[name][i_row]
+            raw.append(unscale(value,scale,vscale,code))
+        else:
+            raw.append(b'' if code[-1]=="s" else 0)
+    return struct.pack(types,*raw)
+
+
+def encode_ublox(name,values,payload=None):
+    """
+    Build a UBlox packet from field values, using the same description in ublox_packets that
+    parse_ublox() decodes it with.
+
+    :param name: name of packet in UBX-xxx-xxx form, or (cls,id) tuple
+    :param values: dict of scaled field values keyed on field name (so a record from parse_ublox()
+                   can be re-encoded with record._asdict()). Fields in the repeating block are
+                   lists, one element per row, and the number of rows is taken from the longest
+                   of them. Fields which aren't in values are zero.
+    :param payload: Raw payload to use instead, for packets without a field description
+    :return: complete packet, including sync and checksum
+    """
+    cls,id=ublox_cls_id(name) if isinstance(name,str) else name
+    packet_desc=get_ublox_desc(cls,id).packet_desc
+    if payload is None:
+        if packet_desc is None:
+            raise ValueError(f"No packet description for {name}, pass the payload instead")
+        payload=encode_part(values,packet_desc.hn,packet_desc.ht,packet_desc.hs,packet_desc.hv)
+        if packet_desc.m>0:
+            n_rows=max([len(values[name]) for name in packet_desc.bn if name in values],default=0)
+            for i_row in range(n_rows):
+                payload+=encode_part(values,packet_desc.bn,packet_desc.bt,packet_desc.bs,packet_desc.bv,i_row)
+            payload+=encode_part(values,packet_desc.fn,packet_desc.ft,packet_desc.fs,packet_desc.fv)
+    return ublox_frame(cls,id,bytes(payload))
+
+
+def parse_packet(packet_type,packet):
+    """
+    Parse a packet of any type
+
+    :param packet_type: PacketType of packet
+    :param packet: complete packet, as produced by the framers
+    :return: record from parse_ublox(), parse_rtcm(), or parse_nmea(), or None if the
+             packet type isn't described
+    :raises struct.error, AssertionError, ValueError: if the packet doesn't match its description
+    """
+    if packet_type==PacketType.UBLOX:
+        return parse_ublox(packet)
+    elif packet_type==PacketType.RTCM:
+        return parse_rtcm(packet)
+    return parse_nmea(packet)
 
-def print_ublox(packet):
-    print(packet.name)
-    dump_bin(packet.payload)
+
+# Templates for print_ublox(), keyed on (cls,id)
+ublox_template=namedtuple("ublox_template","header block_head block_row footer")
+ublox_template_cache={}
+
+
+def field_line_template(names,units,fmts):
+    """
+    :return: %-format template for a list of one-per-line fields, name then value then units
+    """
+    return "".join([f"{name:>21s}: ".replace("%","%%")+fmt+(' '+unit.replace("%","%%") if unit is not None else '')+"\n"
+                    for name,unit,fmt in zip(names,units,fmts)])
+
+
+def get_ublox_template(cls,id):
+    """
+    Get the templates print_ublox() uses for a packet type, building them the first time
+
+    :return: ublox_template with the following elements, or None if the packet has no description:
+      * header -- %-format template of all the header fields, one per line
+      * block_head -- column headings and underlines for the repeating block
+      * block_row -- %-format template of one row of the repeating block, starting with the row number
+      * footer -- %-format template of all the footer fields, one per line
+    """
+    key=(cls,id)
+    if key in ublox_template_cache:
+        return ublox_template_cache[key]
+    packet_desc=get_ublox_desc(cls,id).packet_desc
+    result=None
+    if packet_desc is not None:
+        headings="".join([" "+(f"%-{width}s")%(name+(' ('+unit+')' if unit is not None else ''))
+                          for name,unit,width in zip(packet_desc.bn,packet_desc.bu,packet_desc.bw)])
+        underlines="".join([" "+("-"*width) for width in packet_desc.bw])
+        result=ublox_template(field_line_template(packet_desc.hn,packet_desc.hu,packet_desc.hf),
+                              "  i"+headings+"\n---"+underlines+"\n",
+                              "%3d"+"".join([" "+fmt for fmt in packet_desc.bf])+"\n",
+                              field_line_template(packet_desc.fn,packet_desc.fu,packet_desc.ff))
+    ublox_template_cache[key]=result
+    return result
+
+
+def format_ublox(packet):
+    """
+    Format a parsed packet as text
+
+    :param packet: Packet parsed by parse_ublox()
+    :return: text with the packet name, a hex dump of the payload, and the header fields one
+             per line, the repeating block as a table, and the footer fields one per line
+    :raises ValueError: if the packet has no description
+    """
+    text=[packet.name+"\n",format_bin(packet.payload)]
     if len(packet.payload)==0:
-        print("Null packet")
-        return
-    if packet.desc is not None:
-        for i_header_field,(fieldname,unit,fmt) in enumerate(zip(packet.desc.hn,packet.desc.hu,packet.desc.hf)):
-            i_field=i_header_field
-            value=packet[i_field]
-            print(f"{fieldname:>21s}: ",end='')
-            print(fmt % value,end='')
-            print(' '+unit if unit is not None else '')
-        if packet.n_rep>0:
-            print("  i", end='')
-            for i_block_field,(fieldname,unit,width) in enumerate(zip(packet.desc.bn,packet.desc.bu,packet.desc.bw)):
-                print(" "+(f"%-{width}s")%(fieldname+(' ('+unit+')' if unit is not None else '')),end='')
-            print("")
-            print("---",end='')
-            for width in packet.desc.bw:
-                print(" "+("-"*width),end='')
-            print("")
-            for i_row in range(packet.n_rep):
-                print(f"{i_row:3d}",end='')
-                for i_block_field, (unit,fmt) in enumerate(zip(packet.desc.bu,packet.desc.bf)):
-                    i_field = i_block_field+len(packet.desc.hu)
-                    value = packet[i_field][i_row]
-                    print(" "+fmt % value,end='')
-                print("")
-            for i_footer_field,(fieldname,unit) in enumerate(zip(packet.desc.ff,packet.desc.fu)):
-                i_field=len(packet.desc.hu)+len(packet.desc.bu)+i_footer_field
-                value=packet[i_field]
-                print(f"{fieldname:>21s}: ",end='')
-                print(fmt % value,end='')
-                print(' '+unit if unit is not None else '')
-    else:
+        text.append("Null packet\n")
+        return "".join(text)
+    template=get_ublox_template(packet.cls,packet.id)
+    if template is None:
         raise ValueError(f"No packet description for {packet.name}")
+    n_header=len(packet.desc.hn)
+    n_block=len(packet.desc.bn)
+    text.append(template.header % tuple(packet[:n_header]))
+    if packet.n_rep>0:
+        text.append(template.block_head)
+        block_row=template.block_row
+        columns=packet[n_header:n_header+n_block]
+        text+=[block_row % ((i_row,)+row) for i_row,row in enumerate(zip(*columns))]
+        text.append(template.footer % tuple(packet[n_header+n_block:n_header+n_block+len(packet.desc.fn)]))
+    return "".join(text)
+
+
+def print_ublox(packet, ouf=None):
+    """
+    Print a parsed packet, as formatted by format_ublox()
+
+    :param packet: Packet parsed by parse_ublox()
+    :param ouf: text stream to write to, default standard output. Each packet is one write.
+    """
+    (sys.stdout if ouf is None else ouf).write(format_ublox(packet))
 
 # GPS L1C/A Nav Message description. Each field consists of:
 # key is name of field
@@ -672,7 +1695,7 @@ subframe_123={
         "a_f0":([(271,271+22-1)],True,2**-31,"s",None)
     },
     2:{**tlm_struct,**how_struct,
-        "iode":([(61,68)],False,None,"week",None),
+        "iode":([(61,68)],False,None,None,None),
         "c_rs":([(69,69+16-1)],True,2**-5,"m",None),
         "delta_n":([(91,106)],True,2**-43,"semicircle/s",None),
         "M_0":([(107,107+8-1),(121,121+24-1)],True,2**-31,"semicircle",None),
@@ -684,75 +1707,373 @@ subframe_123={
         "fit":([(287,287)],False,None,None,None),
         "aodo": ([(288,288+5-1)], False,None,None,None),
     },
+    3:{**tlm_struct,**how_struct,
+        "c_ic":([(61,76)],True,2**-29,"rad",None),
+        "Omega_0":([(77,77+8-1),(91,91+24-1)],True,2**-31,"semicircle",None),
+        "c_is":([(121,136)],True,2**-29,"rad",None),
+        "i_0":([(137,137+8-1),(151,151+24-1)],True,2**-31,"semicircle",None),
+        "c_rc":([(181,196)],True,2**-5,"m",None),
+        "omega":([(197,197+8-1),(211,211+24-1)],True,2**-31,"semicircle",None),
+        "Omega_dot":([(241,264)],True,2**-43,"semicircle/s",None),
+        "iode":([(271,278)],False,None,None,None),
+        "i_dot":([(279,292)],True,2**-43,"semicircle/s",None),
+    },
 }
 
 
-def parse_gps_sfrbx(packet):
-    def get_bits(dwrd, b0, b1):
-        dwrd_i = (b0 - 1) // 30
-        rel_0 = b0 - (dwrd_i) * 30
-        rel_1 = b1 - (dwrd_i) * 30
-        width = rel_1 - rel_0 + 1
-        shift = 30 - rel_1
-        mask = (1 << width) - 1
-        return (dwrd[dwrd_i] >> shift) & mask
-    def get_multi_bits(dwrd, parts, signed):
-        result = 0
-        width = 0
-        for (b0, b1) in parts:
-            result = result << (b1 - b0 + 1)
-            result = result | get_bits(dwrd, b0, b1)
-            width += (b1 - b0 + 1)
-        if signed:
-            cutoff = 1 << (width - 1)
-            if result >= cutoff:
-                result -= 2 * cutoff
-        return result
+# Everything needed to pull the fields of one LNAV subframe out of the 30-bit words
+subframe_desc=namedtuple("subframe_desc","subframe names parts widths signed scales vscales units fmts record batch_record")
+subframe_desc_cache={}
+
+
+def compile_subframe(subframe,field_dict):
+    """
+    Compile the description of a subframe from subframe_123 into an extraction plan
+
+    :param subframe: subframe number
+    :param field_dict: field dict from subframe_123
+    :return: subframe_desc with the following elements:
+      * subframe -- as passed in
+      * names -- list of field names
+      * parts -- for each field, tuple of (word index, right shift, mask, width) for each part,
+                 most significant first
+      * widths -- total width of each field in bits
+      * signed -- for each field, the value at and above which the raw value is negative, or
+                  None if the field is unsigned
+      * scales -- for each field, function which scales one raw value
+      * vscales -- for each field, scale suitable for a whole column: None for no scaling, a
+                   number to multiply by, or a lookup table indexed by the unsigned raw value
+                   (or a function that works on arrays, for fields too wide for a table).
+                   None if NumPy isn't available.
+      * units, fmts -- units and format of each field
+      * record -- namedtuple class that parse_gps_sfrbx() returns for this subframe
+      * batch_record -- namedtuple class that parse_gps_sfrbx_batch() returns for this
+                        subframe, with an index field before the others
+    """
     names=[]
+    all_parts=[]
+    widths=[]
+    signeds=[]
+    scales=[]
+    vscales=[]
+    units=[]
+    fmts=[]
+    for name,(parts,signed,scale,unit,fmt) in field_dict.items():
+        field_parts=[]
+        for b0,b1 in parts:
+            i_word=(b0-1)//30
+            width=b1-b0+1
+            field_parts.append((i_word,30-(b1-i_word*30),(1<<width)-1,width))
+        width=sum([part[3] for part in field_parts])
+        cutoff=1<<(width-1) if signed else None
+        if scale is None:
+            scales.append(lambda x:x)
+            vscale=None
+        elif callable(scale):
+            scales.append(scale)
+            vscale=scale
+            if np is not None and width<=16:
+                raw=np.arange(1<<width,dtype=np.int64)
+                if signed:
+                    raw=np.where(raw>=cutoff,raw-2*cutoff,raw)
+                vscale=np.array([scale(int(x)) for x in raw])
+        else:
+            scales.append(partial(lambda s,x:s*x,scale))
+            vscale=scale
+        names.append(name)
+        all_parts.append(tuple(field_parts))
+        widths.append(width)
+        signeds.append(cutoff)
+        vscales.append(vscale if np is not None else None)
+        units.append(unit)
+        fmts.append(fmt)
+    record=namedtuple(f"subframe{subframe}"," ".join(names))
+    batch_record=namedtuple(f"subframe{subframe}_batch","index "+" ".join(names))
+    return subframe_desc(subframe,names,all_parts,widths,signeds,scales,vscales,units,fmts,record,batch_record)
+
+
+def get_subframe_desc(subframe):
+    """
+    :param subframe: subframe number
+    :return: compiled description of an LNAV subframe, from compile_subframe(), or None if
+             the subframe isn't in subframe_123
+    """
+    if subframe not in subframe_desc_cache:
+        subframe_desc_cache[subframe]=compile_subframe(subframe,subframe_123[subframe]) if subframe in subframe_123 else None
+    return subframe_desc_cache[subframe]
+
+
+def parse_gps_sfrbx(packet):
+    """
+    Decode a GPS LNAV subframe
+
+    :param packet: record of UBX-RXM-SFRBX from parse_ublox() (with or without arrays) or parse_ublox_lazy()
+    :return: namedtuple of the fields of the subframe, scaled, or None if the subframe isn't in subframe_123
+    """
+    # Python ints, since with arrays=True the words are uint32, which the shifts and sign fixes would overflow
+    dwrd=[int(word) for word in packet.dwrd]
+    desc=get_subframe_desc((dwrd[1]>>8) & 0x07)
+    if desc is None:
+        return None
     values=[]
-    subframe=get_bits(packet.dwrd,50,52)
-    if subframe==2:
-        print(2)
-    if subframe in subframe_123:
-        for name,(parts,signed,scale,units,fmt) in subframe_123[subframe].items():
-            names.append(name)
-            value=get_multi_bits(packet.dwrd,parts,signed)
-            if callable(scale):
-                value=scale(value)
-            elif scale is not None:
-                value=scale*value
-            values.append(value)
-        return namedtuple(f"subframe{subframe}", " ".join(names))._make(values)
+    for parts,cutoff,scale in zip(desc.parts,desc.signed,desc.scales):
+        value=0
+        for i_word,shift,mask,width in parts:
+            value=(value<<width) | ((dwrd[i_word]>>shift) & mask)
+        if cutoff is not None and value>=cutoff:
+            value-=2*cutoff
+        values.append(scale(value))
+    return desc.record._make(values)
+
+
+def parse_gps_sfrbx_batch(dwrds):
+    """
+    Decode many GPS LNAV subframes at once with NumPy
+
+    :param dwrds: words of each subframe, as a 2D array-like with one row of 10 words per subframe,
+                  like the dwrd field of UBX-RXM-SFRBX
+    :return: dict keyed on subframe number of namedtuples of columns. The index column is
+             the row in dwrds of each subframe, and the other columns are NumPy arrays of the
+             scaled fields, the same as parse_gps_sfrbx() returns one at a time. Only the subframes
+             in subframe_123 which appear at least once are included.
+    """
+    if np is None:
+        raise ImportError("NumPy is required for parse_gps_sfrbx_batch()")
+    dwrds=np.asarray(dwrds,dtype=np.int64).reshape(-1,10)
+    subframes=(dwrds[:,1]>>8) & 0x07
+    result={}
+    for subframe in subframe_123:
+        index=np.flatnonzero(subframes==subframe)
+        if len(index)==0:
+            continue
+        desc=get_subframe_desc(subframe)
+        words=dwrds[index]
+        columns=[index]
+        for parts,cutoff,vscale in zip(desc.parts,desc.signed,desc.vscales):
+            column=np.zeros(len(index),dtype=np.int64)
+            for i_word,shift,mask,width in parts:
+                column=(column<<width) | ((words[:,i_word]>>shift) & mask)
+            if isinstance(vscale,np.ndarray):
+                columns.append(vscale[column])
+                continue
+            if cutoff is not None:
+                column=np.where(column>=cutoff,column-2*cutoff,column)
+            columns.append(scale_column(column,vscale))
+        result[subframe]=desc.batch_record._make(columns)
+    return result
+
+
+def gps_sfrbx_words(source):
+    """
+    Gather the words of every GPS LNAV subframe in a log, without decoding anything else
+
+    :param source: name of log file, or buffer holding log as for frame_buffer()
+    :return: Tuple of NumPy arrays, one element or row per subframe:
+      * offset of SFRBX packet in log
+      * svId of satellite
+      * 2D array of words, 10 per row, suitable for parse_gps_sfrbx_batch()
+    """
+    if np is None:
+        raise ImportError("NumPy is required for gps_sfrbx_words()")
+    buf=map_file(source) if isinstance(source,str) else source
+    ofss=[]
+    svIds=[]
+    words=[]
+    for packet_type,ofs,packet in frame_buffer(buf,subscribe=Subscription(["UBX-RXM-SFRBX"])):
+        # gnssId GPS, sigId L1C/A, 10 words
+        if packet[6]==GNSS.GPS.value and packet[8]==0 and packet[10]==10 and len(packet)==6+8+40+2:
+            ofss.append(ofs)
+            svIds.append(packet[7])
+            words.append(bytes(packet[14:54]))
+    return (np.array(ofss,dtype=np.int64),np.array(svIds,dtype=np.uint8),
+            np.frombuffer(b"".join(words),dtype="<u4").reshape(-1,10))
+
+def json_value(value):
+    """
+    Convert a field value into something json can write
+
+    :param value: field value from parse_ublox(), parse_rtcm(), or parse_nmea()
+    :return: Enums as their name, bytes as hex, dicts with string keys (MSM (prn,sig)
+             keys as "prn:sig"), lists and NumPy arrays as lists, anything else as is
+    """
+    if isinstance(value,Enum):
+        return value.name
+    if isinstance(value,(bytes,bytearray,memoryview)):
+        return bytes(value).hex()
+    if isinstance(value,dict):
+        return {(":".join([str(json_value(x)) for x in key]) if isinstance(key,tuple) else str(json_value(key))):
+                json_value(x) for key,x in value.items()}
+    if isinstance(value,(list,tuple)):
+        return [json_value(x) for x in value]
+    if np is not None:
+        if isinstance(value,np.ndarray):
+            return json_value(value.tolist())
+        if isinstance(value,np.generic):
+            return value.item()
+    return value
+
+
+def record_fields(packet_type,parsed):
+    """
+    :return: dict of the field values of a parsed packet, without the bookkeeping elements
+             (payload, desc, units, fmts) that aren't part of the message
+    """
+    fields=parsed._asdict()
+    if packet_type==PacketType.UBLOX:
+        del fields["payload"],fields["desc"],fields["cls"],fields["id"],fields["name"]
+    elif packet_type==PacketType.RTCM:
+        del fields["units"],fields["fmts"]
+    return fields
+
+
+def cli_packets(args,subscribe):
+    """
+    Frame and decode every input named on the command line
+
+    :return: Generator of tuples of PacketType, offset in its input, complete packet, and
+             parsed record (None if the packet type isn't described), or the exception raised
+             if it couldn't be decoded
+    """
+    for source in args.inputs:
+        if source=="-":
+            frames=frame_stream(sys.stdin.buffer,subscribe=subscribe)
+        elif args.workers>1:
+            from parse_parallel import parse_parallel
+            packets=parse_parallel(source,args.workers,subscribe=subscribe,with_packets=True,errors=True)
+            for packet_type,ofs,packet,parsed in packets:
+                if metrics_ublox.active is not None:
+                    #Framing and decoding happened in the workers, so count the packets and errors here
+                    metrics_ublox.active.frame(packet_name(packet_type,packet),len(packet))
+                    if isinstance(parsed,Exception):
+                        metrics_ublox.active.decode_error(packet_name(packet_type,packet),parsed)
+                yield packet_type,ofs,packet,parsed
+            continue
+        else:
+            frames=frame_buffer(map_file(source),subscribe=subscribe)
+        for packet_type,ofs,packet in frames:
+            try:
+                parsed=parse_packet(packet_type,packet)
+            except (struct.error,AssertionError,ValueError) as e:
+                parsed=e
+            yield packet_type,ofs,packet,parsed
+
+
+def write_text(ouf,packet_type,ofs,packet,parsed):
+    """
+    Write one packet as text: offset and length, then the sentence for NMEA, the fields and
+    a hex dump for UBlox (plus the subframe for GPS RXM-SFRBX), and the record for RTCM.
+    Packets which couldn't be decoded get the error and a hex dump.
+    """
+    ouf.write(f"ofs: {ofs:08x}, pkt_len: {len(packet)}\n")
+    if isinstance(parsed,Exception):
+        ouf.write(f"Could not decode: {type(parsed).__name__}: {parsed}\n")
+        dump_bin(packet,ouf=ouf)
+    elif packet_type==PacketType.NMEA:
+        ouf.write(str(packet,encoding='cp437').strip()+"\n")
+    elif packet_type==PacketType.UBLOX:
+        if parsed.desc is None:
+            ouf.write(parsed.name+"\n")
+            dump_bin(parsed.payload,ouf=ouf)
+        else:
+            print_ublox(parsed,ouf)
+            if (parsed.name=="UBX-RXM-SFRBX") and (parsed.gnssId==GNSS.GPS) and (parsed.sigId==0):
+                ouf.write(f"{parse_gps_sfrbx(parsed)}\n")
     else:
-        return None
+        ouf.write(f"{parsed}\n")
+
 
-def main():
-    with open("fluttershy_rtcm3_220404_181911.ubx","rb") as inf:
-        ofs=0
-        while True:
-            packet_type,packet=next_packet(inf)
-            print(f"ofs: {ofs:08x}, pkt_len: {len(packet)}")
-            ofs+=len(packet)
-            if packet_type==PacketType.NMEA:
-                print(packet)
-            elif packet_type==PacketType.UBLOX:
-                try:
-                    parsed_packet=parse_ublox(packet)
-                    print_ublox(parsed_packet)
-                    if (parsed_packet.name=="UBX-RXM-SFRBX") and (parsed_packet.gnssId==GNSS.GPS) and (parsed_packet.sigId==0):
-                        parsed_subframe=parse_gps_sfrbx(parsed_packet)
-                        print(parsed_subframe)
-                except struct.error:
-                    traceback.print_exc()
-                    dump_bin(packet)
-            elif packet_type==PacketType.RTCM:
-                try:
-                    parsed_packet=parse_rtcm(packet,verbose=False)
-                    print(parsed_packet)
-                except AssertionError:
-                    traceback.print_exc()
-                    dump_bin(packet)
+def main(argv=None):
+    """
+    Command line interface. Run with --help for usage.
+
+    :param argv: list of arguments, default sys.argv[1:]
+    :return: exit status, 0 if every packet was decoded, 1 if some couldn't be
+    """
+    import argparse
+    parser=argparse.ArgumentParser(prog="python -m parse_ublox",
+                                   description="Decode recorded or live streams of UBlox, RTCM, and NMEA packets")
+    parser.add_argument("inputs",nargs="*",default=["-"],help="log files to read, - for standard input (default)")
+    parser.add_argument("-m","--message",action="append",dest="messages",metavar="NAME",
+                        help="only handle this message type: UBX-xxx-xxx, RTCM message number, or NMEA "
+                             "sentence formatter like GGA. May be given more than once.")
+    parser.add_argument("-f","--format",choices=("text","jsonl","columnar","parquet","arrow"),default="text",
+                        help="text: readable dump of each packet. jsonl: one JSON object per packet. "
+                             "columnar: one JSON object at the end, with a dict of columns per message type. "
+                             "parquet, arrow: one Parquet or Arrow IPC file per message type, in the "
+                             "--output directory. Needs pyarrow.")
+    parser.add_argument("-o","--output",help="file to write to, default standard output. Directory to write "
+                                             "to for parquet and arrow.")
+    parser.add_argument("-q","--quiet",action="store_true",help="don't write the packets")
+    parser.add_argument("-s","--stats",action="store_true",
+                        help="write counts of packets, bytes, and errors at the end, as JSON. They go to "
+                             "standard error, or standard output with --quiet.")
+    parser.add_argument("-w","--workers",type=int,default=1,
+                        help="decode files (not standard input) with this many processes")
+    args=parser.parse_args(argv)
+    subscribe=None
+    if args.messages is not None:
+        subscribe=Subscription([int(name) if name.isdigit() else name for name in args.messages])
+    exporter=None
+    if args.format in ("parquet","arrow"):
+        if args.output is None:
+            parser.error(f"--output directory is needed for {args.format}")
+        from export_arrow import ArrowExporter
+        exporter=ArrowExporter(args.output,format=args.format)
+    metrics=metrics_ublox.enable() if args.stats else None
+    ouf=sys.stdout if args.output is None or exporter is not None else open(args.output,"w")
+    columns={}
+    n_errors=0
+    try:
+        for packet_type,ofs,packet,parsed in cli_packets(args,subscribe):
+            if isinstance(parsed,Exception):
+                n_errors+=1
+            if args.quiet:
+                continue
+            if args.format=="text":
+                write_text(ouf,packet_type,ofs,packet,parsed)
+                continue
+            if parsed is None or isinstance(parsed,Exception):
+                continue
+            if exporter is not None:
+                exporter.add(packet_type,ofs,packet,parsed)
+                continue
+            name=packet_name(packet_type,packet)
+            fields=record_fields(packet_type,parsed)
+            if args.format=="jsonl":
+                ouf.write(json.dumps({"type":packet_type.name,"name":name,"ofs":ofs,
+                                      **{field:json_value(value) for field,value in fields.items()}})+"\n")
+            else:
+                table=columns.setdefault(name,{})
+                n_rows=len(next(iter(table.values()))) if len(table)>0 else 0
+                for field,value in fields.items():
+                    #Fields can differ between packets of one type (like NMEA talkers), pad with None
+                    table.setdefault(field,[None]*n_rows).append(json_value(value))
+                for column in table.values():
+                    if len(column)==n_rows:
+                        #Field missing from this packet
+                        column.append(None)
+        if args.format=="columnar" and not args.quiet:
+            json.dump(columns,ouf)
+            ouf.write("\n")
+        if metrics is not None:
+            json.dump(metrics.snapshot(),sys.stdout if args.quiet else sys.stderr,indent=2)
+            (sys.stdout if args.quiet else sys.stderr).write("\n")
+    except BrokenPipeError:
+        #Reader went away, like head. Point stdout at devnull so the exit flush doesn't complain.
+        os.dup2(os.open(os.devnull,os.O_WRONLY),sys.stdout.fileno())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if exporter is not None:
+            exporter.close()
+        elif args.output is not None:
+            ouf.close()
+        metrics_ublox.disable()
+    return 1 if n_errors>0 else 0
 
 
 if __name__=="__main__":
-    main()
+    # Run main() from the module as imported under its own name, so that everything (like
+    # PacketType) is the same object here as in the other modules, which import parse_ublox.
+    import parse_ublox
+    sys.exit(parse_ublox.main())
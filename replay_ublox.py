@@ -0,0 +1,138 @@
+"""
+Replay a recorded (or synthetic) stream to a file, pipe, or TCP client, paced by the
+time of week in the packets and sped up by a rate multiplier. Useful for load-testing
+a consumer at many times real time.
+
+Usage: python replay_ublox.py [--rate X] [--loops N] [--synthetic EPOCHS] [log] output
+
+output is a filename (which may be a named pipe), - for standard output, or tcp:PORT
+or tcp:HOST:PORT to listen for one client and send to it.
+"""
+import argparse
+import socket
+import sys
+import time
+
+from parse_ublox import map_file
+from packet_index import build_index, no_tow
+
+# Length of a GPS week in ms, for unwrapping time of week
+week_ms=604800000
+
+
+def packet_groups(index):
+    """
+    Group the packets of a log into runs which should be sent at once
+
+    :param index: PacketIndex of log
+    :return: Generator of tuples of start and end offset of the run in the log, and time of
+             the run in ms, relative to the first packet with a time of week. Each run starts
+             with a packet with a new time of week, and includes the packets after it without
+             one. Packets before the first time of week are at time 0.
+    """
+    start=None
+    end=0
+    t=0
+    tow0=None
+    last_tow=None
+    week=0
+    for entry in index:
+        if entry.tow!=no_tow and entry.tow!=last_tow:
+            if last_tow is not None and entry.tow<last_tow-week_ms//2:
+                week+=1
+            if tow0 is None:
+                tow0=entry.tow
+            last_tow=entry.tow
+            new_t=week*week_ms+entry.tow-tow0
+            if new_t>t:
+                if start is not None:
+                    yield start,end,t
+                start=None
+                t=new_t
+        if start is None:
+            start=entry.ofs
+        end=entry.ofs+entry.length
+    if start is not None:
+        yield start,end,t
+
+
+def replay(buf,index,write,rate=1.0,loops=1):
+    """
+    Send a log, pacing the packets by their time of week
+
+    :param buf: buffer holding log
+    :param index: PacketIndex of log
+    :param write: function to call with each run of bytes to send
+    :param rate: speed relative to real time, 10 to send ten times as fast as the log was
+                 recorded. 0 sends as fast as possible.
+    :param loops: number of times to send the log. Each loop starts right after the last
+                  packet of the one before.
+    :return: number of bytes sent
+    """
+    groups=list(packet_groups(index))
+    duration=groups[-1][2] if len(groups)>0 else 0
+    view=memoryview(buf)
+    t0=time.monotonic()
+    sent=0
+    for i_loop in range(loops):
+        for start,end,t in groups:
+            if rate>0:
+                delay=t0+(i_loop*duration+t)/1000/rate-time.monotonic()
+                if delay>0:
+                    time.sleep(delay)
+            write(view[start:end])
+            sent+=end-start
+    return sent
+
+
+def open_output(spec):
+    """
+    :param spec: filename, - for standard output, or tcp:PORT or tcp:HOST:PORT
+    :return: Tuple of a write function and a close function. For TCP, this waits for a
+             client to connect.
+    """
+    if spec=="-":
+        return sys.stdout.buffer.write,sys.stdout.buffer.flush
+    if spec.startswith("tcp:"):
+        parts=spec.split(":")
+        host,port=("127.0.0.1",parts[1]) if len(parts)==2 else parts[1:3]
+        with socket.create_server((host,int(port))) as server:
+            print(f"Waiting for a client on {host}:{port}",file=sys.stderr)
+            conn,addr=server.accept()
+        return conn.sendall,conn.close
+    ouf=open(spec,"wb",buffering=0)
+    return ouf.write,ouf.close
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Replay a UBlox/RTCM/NMEA stream at a multiple of real time")
+    parser.add_argument("log",nargs="?",help="recorded log to replay")
+    parser.add_argument("output",help="filename, - for standard output, or tcp:[HOST:]PORT")
+    parser.add_argument("--rate",type=float,default=1.0,help="speed relative to real time, 0 for as fast as possible")
+    parser.add_argument("--loops",type=int,default=1,help="number of times to send the log")
+    parser.add_argument("--synthetic",type=int,metavar="EPOCHS",
+                        help="send a synthetic log with this many one-second epochs instead of a recorded one")
+    parser.add_argument("--seed",type=int,default=0,help="seed for the synthetic log")
+    args=parser.parse_args(argv)
+    if args.synthetic is not None:
+        from bench_ublox import make_corpus
+        buf=make_corpus(args.synthetic,args.seed)
+    elif args.log is not None:
+        buf=map_file(args.log)
+    else:
+        parser.error("Either a log or --synthetic is needed")
+    index=build_index(buf)
+    write,close=open_output(args.output)
+    t0=time.monotonic()
+    try:
+        sent=replay(buf,index,write,args.rate,args.loops)
+    except BrokenPipeError:
+        return
+    finally:
+        close()
+    elapsed=time.monotonic()-t0
+    print(f"Sent {sent} bytes in {elapsed:.3f} s ({sent/max(elapsed,1e-9)/1e6:.2f} MB/s)",file=sys.stderr)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+Write RINEX 3 observation files from UBX-RXM-RAWX, one epoch at a time as the packets
+arrive, so that memory use doesn't depend on the length of the log.
+
+The observation types in the header depend on which signals turn up, which isn't known
+until the end. Each new signal is given the next columns of its system as it is first
+seen, so earlier epochs just have fewer (trailing) observations, and the header is written
+last. Space for the largest possible header is reserved at the start of the file, and
+filled in place when the writer is closed, padded with COMMENT lines. The output must
+therefore be a regular file, not a pipe.
+
+Usage: python rinex_ublox.py [--marker NAME] ... log output.obs
+"""
+import argparse
+import datetime
+import struct
+import sys
+
+from parse_ublox import PacketType, GNSS, np, map_file, frame_buffer, parse_ublox, Subscription, ublox_cls_id
+
+rawx_cls_id=ublox_cls_id("UBX-RXM-RAWX")
+
+# RINEX satellite system letter for each GNSS
+rinex_systems={GNSS.GPS:"G",GNSS.SBAS:"S",GNSS.GAL:"E",GNSS.BDS:"C",GNSS.QZSS:"J",GNSS.GLO:"R",GNSS.NavIC:"I"}
+
+# RINEX band and attribute of each RAWX sigId, from the signal identifier table in the UBX manual.
+# Signals not in here are left out.
+rinex_codes={GNSS.GPS:  {0:"1C",3:"2L",4:"2S",6:"5I",7:"5Q"},
+             GNSS.SBAS: {0:"1C"},
+             GNSS.GAL:  {0:"1C",1:"1B",3:"5I",4:"5Q",5:"7I",6:"7Q"},
+             GNSS.BDS:  {0:"2I",1:"2I",2:"7I",3:"7I",5:"1P",7:"5P"},
+             GNSS.QZSS: {0:"1C",1:"1Z",4:"2S",5:"2L",8:"5I",9:"5Q"},
+             GNSS.GLO:  {0:"1C",2:"2C"},
+             GNSS.NavIC:{0:"5A"}}
+
+# System letter and band/attribute of each signal, keyed on gnssId code and sigId
+rinex_signals={(gnss.value,sigId):(rinex_systems[gnss],code) for gnss,codes in rinex_codes.items()
+               for sigId,code in codes.items()}
+
+# gnssId codes which need special handling, looked up once since Enum attribute access is slow
+gnss_sbas=GNSS.SBAS.value
+gnss_glo=GNSS.GLO.value
+
+# Observations written for each signal: pseudorange, carrier phase, Doppler, and signal strength
+rinex_obs_kinds="CLDS"
+
+# Start of GPS time
+gps_epoch=datetime.date(1980,1,6)
+
+# Bits of RAWX trkStat
+trk_pr_valid=0x01
+trk_cp_valid=0x02
+trk_half_cyc=0x04
+
+# Observations have to fit in F14.3
+rinex_obs_max=1e9
+
+
+def rinex_prn(gnss,svId):
+    """
+    :param gnss: gnssId code
+    :return: RINEX satellite number, or None if the satellite can't be written
+    """
+    if gnss==gnss_sbas:
+        return svId-100 if 120<=svId<=158 else None
+    if gnss==gnss_glo:
+        #255 is an unknown slot
+        return svId if 1<=svId<=32 else None
+    return svId if 1<=svId<=99 else None
+
+
+def header_line(content,label):
+    """
+    :return: one header line, content in the first 60 columns and the label after
+    """
+    return f"{content:<60.60s}{label:<20s}\n"
+
+
+def gps_calendar(t7):
+    """
+    :param t7: GPS time in units of 1e-7 s since the GPS epoch
+    :return: tuple of year, month, day, hour, minute, and seconds
+    """
+    day,sod=divmod(t7,864000000000)
+    date=gps_epoch+datetime.timedelta(days=day)
+    hour,rem=divmod(sod,36000000000)
+    minute,sec=divmod(rem,600000000)
+    return date.year,date.month,date.day,hour,minute,sec/1e7
+
+
+def rinex_header(obs_types,glo_slots,first,last=None,interval=None,leap=None,marker="UNKNOWN",
+                 marker_type="NON_GEODETIC",observer="",agency="",receiver="",antenna="",
+                 approx_xyz=(0.0,0.0,0.0),program="rinex_ublox"):
+    """
+    Make the lines of a RINEX 3.04 observation header
+
+    :param obs_types: dict keyed on system letter of lists of observation types, like C1C
+    :param glo_slots: dict of GLONASS frequency numbers keyed on slot number
+    :param first: time of first epoch, as for gps_calendar(), or None if there are no epochs
+    :param last: time of last epoch, or None to leave it out
+    :param interval: observation interval in seconds, or None to leave it out
+    :param leap: number of leap seconds, or None to leave it out
+    :return: list of header lines, without END OF HEADER
+    """
+    systems=[system for system in rinex_systems.values() if system in obs_types]
+    lines=[header_line(f"{3.04:9.2f}{'':11s}{'OBSERVATION DATA':20s}"
+                       f"{systems[0] if len(systems)==1 else 'M':20s}","RINEX VERSION / TYPE"),
+           header_line(f"{program:20.20s}{'':20s}{datetime.datetime.now(datetime.timezone.utc):%Y%m%d %H%M%S} UTC",
+                       "PGM / RUN BY / DATE"),
+           header_line(marker,"MARKER NAME"),
+           header_line(marker_type,"MARKER TYPE"),
+           header_line(f"{observer:20.20s}{agency:40.40s}","OBSERVER / AGENCY"),
+           header_line(f"{'':20s}{receiver:20.20s}","REC # / TYPE / VERS"),
+           header_line(f"{'':20s}{antenna:20.20s}","ANT # / TYPE"),
+           header_line("".join([f"{x:14.4f}" for x in approx_xyz]),"APPROX POSITION XYZ"),
+           header_line(f"{0.0:14.4f}{0.0:14.4f}{0.0:14.4f}","ANTENNA: DELTA H/E/N")]
+    for system in systems:
+        types=obs_types[system]
+        for i in range(0,max(len(types),1),13):
+            head=f"{system:1s}  {len(types):3d}" if i==0 else ""
+            lines.append(header_line(f"{head:6s}"+"".join([f" {type:3s}" for type in types[i:i+13]]),
+                                     "SYS / # / OBS TYPES"))
+    for system in systems:
+        lines.append(header_line(system,"SYS / PHASE SHIFT"))
+    if "R" in obs_types:
+        slots=sorted(glo_slots.items())
+        for i in range(0,max(len(slots),1),8):
+            head=f"{len(slots):3d}" if i==0 else ""
+            lines.append(header_line(f"{head:4s}"+"".join([f"R{slot:02d} {k:2d} " for slot,k in slots[i:i+8]]),
+                                     "GLONASS SLOT / FRQ #"))
+        lines.append(header_line("","GLONASS COD/PHS/BIS"))
+    if interval is not None:
+        lines.append(header_line(f"{interval:10.3f}","INTERVAL"))
+    if first is not None:
+        lines.append(header_line("%6d%6d%6d%6d%6d%13.7f     GPS" % gps_calendar(first),"TIME OF FIRST OBS"))
+    if last is not None:
+        lines.append(header_line("%6d%6d%6d%6d%6d%13.7f     GPS" % gps_calendar(last),"TIME OF LAST OBS"))
+    if leap is not None:
+        lines.append(header_line(f"{leap:6d}","LEAP SECONDS"))
+    return lines
+
+
+class RinexObsWriter:
+    """
+    Write a RINEX observation file from decoded UBX-RXM-RAWX packets
+    """
+    def __init__(self,filename,**header):
+        """
+        :param filename: name of file to write
+        :param header: passed on to rinex_header(): marker, marker_type, observer, agency,
+                       receiver, antenna, approx_xyz, and program
+        """
+        self.header=header
+        # Observation types of each system, in the order they were first seen, keyed on system letter
+        self.obs_types={}
+        # Column of the first observation of each signal on its line, keyed on system letter and band/attribute
+        self.columns={}
+        self.glo_slots={}
+        # Lock time of each signal in the last epoch, to spot loss of lock
+        self.locktimes={}
+        self.first=None
+        self.last=None
+        self.interval=None
+        self.leap=None
+        self.n_epochs=0
+        # Reserve room for the header with every system and signal, and every GLONASS slot
+        full=rinex_header({rinex_systems[gnss]:[kind+code for code in set(codes.values()) for kind in rinex_obs_kinds]
+                           for gnss,codes in rinex_codes.items()},{slot:0 for slot in range(1,33)},
+                          0,0,0.0,0,**header)
+        self.header_lines=len(full)+1
+        self.ouf=open(filename,"wb")
+        self.write_header()
+
+    def write_header(self):
+        """
+        Write the header at the start of the file, padded with comments to the reserved length
+        """
+        lines=rinex_header(self.obs_types,self.glo_slots,self.first,self.last,self.interval,self.leap,**self.header)
+        if len(lines)+1>self.header_lines:
+            raise ValueError("RINEX header doesn't fit in the space reserved for it")
+        lines+=[header_line("","COMMENT")]*(self.header_lines-len(lines)-1)
+        lines.append(header_line("","END OF HEADER"))
+        pos=self.ouf.tell()
+        self.ouf.seek(0)
+        self.ouf.write("".join(lines).encode("ascii"))
+        if pos>0:
+            self.ouf.seek(pos)
+
+    def column(self,system,code):
+        """
+        :return: column of the pseudorange of a signal, adding its observation types to its
+                 system if it hasn't been seen yet
+        """
+        key=(system,code)
+        column=self.columns.get(key)
+        if column is None:
+            types=self.obs_types.setdefault(system,[])
+            column=self.columns[key]=len(types)
+            types+=[kind+code for kind in rinex_obs_kinds]
+        return column
+
+    def add(self,rawx):
+        """
+        Write one epoch
+
+        :param rawx: record of UBX-RXM-RAWX from parse_ublox() (with or without arrays) or parse_ublox_lazy()
+        """
+        sats={}
+        columns=[getattr(rawx,name) for name in ("prMes","cpMes","doMes","gnssId","svId","sigId","freqId",
+                                                "locktime","cno","trkStat")]
+        # Plain lists are much faster to go through than arrays, and gnssId is wanted as codes
+        columns=[column.tolist() if hasattr(column,"tolist") else column for column in columns]
+        if len(columns[3])>0 and isinstance(columns[3][0],GNSS):
+            columns[3]=[gnss.value for gnss in columns[3]]
+        for prMes,cpMes,doMes,gnss,svId,sigId,freqId,locktime,cno,trkStat in zip(*columns):
+            signal=rinex_signals.get((gnss,sigId))
+            prn=rinex_prn(gnss,svId)
+            if signal is None or prn is None:
+                continue
+            system,code=signal
+            if gnss==gnss_glo:
+                self.glo_slots[prn]=freqId-7
+            column=self.column(system,code)
+            obs=sats.setdefault((system,prn),{})
+            if trkStat & trk_pr_valid and abs(prMes)<rinex_obs_max:
+                obs[column]=f"{prMes:14.3f}  "
+            if trkStat & trk_cp_valid and abs(cpMes)<rinex_obs_max:
+                key=(system,prn,code)
+                lli=0 if locktime>=self.locktimes.get(key,0) and locktime>0 else 1
+                if not trkStat & trk_half_cyc:
+                    lli|=2
+                self.locktimes[key]=locktime
+                obs[column+1]=f"{cpMes:14.3f}{lli if lli else ' '}{min(max(cno//6,1),9)}"
+            if abs(doMes)<rinex_obs_max:
+                obs[column+2]=f"{doMes:14.3f}  "
+            obs[column+3]=f"{cno:14.3f}  "
+        if len(sats)==0:
+            return
+        t7=round((rawx.week*604800+rawx.rcvTow)*1e7)
+        if self.first is None:
+            self.first=t7
+        elif t7>self.last and (self.interval is None or t7-self.last<self.interval*1e7):
+            self.interval=(t7-self.last)/1e7
+        self.last=t7
+        if rawx.recStat & 0x01:
+            self.leap=rawx.leapS
+        lines=["> %4d %02d %02d %02d %02d%11.7f  0%3d\n" % (*gps_calendar(t7),len(sats))]
+        blank=" "*16
+        for (system,prn),obs in sorted(sats.items()):
+            line=[f"{system}{prn:02d}"]
+            for i in range(max(obs)+1):
+                line.append(obs.get(i,blank))
+            lines.append("".join(line).rstrip()+"\n")
+        self.ouf.write("".join(lines).encode("ascii"))
+        self.n_epochs+=1
+
+    def close(self):
+        """
+        Fill in the header and close the file
+        """
+        self.write_header()
+        self.ouf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+
+def rinex_from_log(source,filename,**header):
+    """
+    Write the RXM-RAWX packets of a log to a RINEX observation file. Only the RAWX packets are decoded.
+
+    :param source: name of log file, or buffer holding log as for frame_buffer()
+    :param filename: name of RINEX file to write
+    :param header: passed on to RinexObsWriter
+    :return: number of epochs written
+    """
+    buf=map_file(source) if isinstance(source,str) else source
+    with RinexObsWriter(filename,**header) as writer:
+        for packet_type,ofs,packet in frame_buffer(buf,subscribe=Subscription(["UBX-RXM-RAWX"])):
+            if packet_type!=PacketType.UBLOX or (packet[2],packet[3])!=rawx_cls_id:
+                continue
+            try:
+                rawx=parse_ublox(packet,arrays=np is not None)
+            except (struct.error,AssertionError,ValueError):
+                continue
+            writer.add(rawx)
+    return writer.n_epochs
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Write the UBX-RXM-RAWX packets of a log as a RINEX 3 observation file")
+    parser.add_argument("log",help="log to read")
+    parser.add_argument("output",help="RINEX file to write")
+    parser.add_argument("--marker",default="UNKNOWN",help="marker name")
+    parser.add_argument("--observer",default="",help="name of observer")
+    parser.add_argument("--agency",default="",help="name of agency")
+    parser.add_argument("--receiver",default="",help="receiver type")
+    parser.add_argument("--antenna",default="",help="antenna type")
+    args=parser.parse_args(argv)
+    n_epochs=rinex_from_log(args.log,args.output,marker=args.marker,observer=args.observer,
+                            agency=args.agency,receiver=args.receiver,antenna=args.antenna)
+    print(f"Wrote {n_epochs} epochs",file=sys.stderr)
+
+
+if __name__=="__main__":
+    main()